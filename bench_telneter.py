@@ -0,0 +1,504 @@
+'''
+Benchmark suite for the hot paths in telneter.
+
+  python3 bench_telneter.py                      # run everything and print a table
+  python3 bench_telneter.py -k parse             # only benchmarks with 'parse' in the name
+  python3 bench_telneter.py --save base.json     # keep the results
+  python3 bench_telneter.py --compare base.json  # exit 1 if anything got more than --max-drop % slower
+  python3 bench_telneter.py --trace session.cap  # replay a telneter_capture file as a benchmark too
+
+Every benchmark is timed --repeat times and we report the median throughput along
+with the 10th and 90th percentiles, so one noisy run doesn't make or break a result.
+'''
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import timeit
+
+import find_IACSE
+import telneter
+import telneter_aio
+import telneter_capture
+import telneter_pool
+from telneter import IAC, WILL, WONT, DO, DONT, SB, SE, NOP, GA, ECHO, STATUS, NAWS, TTYPE, GMCP
+from telneter_capture import percentile
+
+# name: function returning (run, amount, unit), run() does amount units of work
+all_benchmarks = {}
+
+
+def register_benchmark(name):
+    def register(func):
+        all_benchmarks[name] = func
+        return func
+    return register
+
+
+# workloads
+
+def mud_text(size):
+    ''' MUD style output: lines of text with the odd negotiation and a prompt '''
+    room = (b'The Dusty Road\r\n'
+            b'A long road stretches east and west, the dust rising in small clouds.\r\n'
+            b'Exits: east west\r\n')
+    chunk = room + IAC+WILL+ECHO + room + IAC+SB+STATUS + b'hp 100 mp 50' + IAC+SE + b'> ' + IAC+GA
+    return chunk * (size // len(chunk))
+
+
+def gmcp_stream(size):
+    ''' a server that sends most of its state as GMCP subnegotiations '''
+    vitals = IAC+SB+GMCP + b'Char.Vitals {"hp": 100, "maxhp": 120, "mp": 50, "maxmp": 80}' + IAC+SE
+    room = IAC+SB+GMCP + b'Room.Info {"num": 1234, "name": "The Dusty Road", "exits": {"e": 1235}}' + IAC+SE
+    chunk = vitals + b'You hit the rat.\r\n' + vitals + room + b'> ' + IAC+GA
+    return chunk * (size // len(chunk))
+
+
+def all_iacs(size):
+    ''' the pathological case, nothing but escaped IACs in the text and in an SB '''
+    half = size // 4
+    return (IAC+IAC) * half + IAC+SB+STATUS + (IAC+IAC) * half + IAC+SE
+
+
+WORKLOADS = {
+    'mud': mud_text,
+    'gmcp': gmcp_stream,
+    'all_iac': all_iacs,
+}
+
+
+def chunked(data, size):
+    return [data[i:i+size] for i in range(0, len(data), size)]
+
+
+# benchmarks
+
+def _register_finders():
+    for blob_name, blob in find_IACSE.regression_blobs():
+        for finder in find_IACSE.all_finders:
+            def bench(finder=finder, blob=blob):
+                data = IAC+SB+STATUS + blob + IAC+SE
+                return lambda: finder(data), len(data), 'bytes'
+            register_benchmark('find_IACSE.%s.%s' % (finder.__name__, blob_name))(bench)
+
+
+_register_finders()
+
+
+def _register_parsers():
+    for workload_name, workload in sorted(WORKLOADS.items()):
+        def parse_all(workload=workload):
+            data = workload(1024 * 1024)
+            return lambda: telneter.parse_all(data), len(data), 'bytes'
+        register_benchmark('parse_all.%s' % workload_name)(parse_all)
+
+        def receive_data(workload=workload):
+            data = workload(1024 * 1024)
+            chunks = chunked(data, 4096)
+
+            def run():
+                stream = telneter.TelnetStream()
+                for chunk in chunks:
+                    stream.receive_data(chunk)
+            return run, len(data), 'bytes'
+        register_benchmark('receive_data.%s.4k' % workload_name)(receive_data)
+
+        def fragmented(workload=workload):
+            # one byte per read, the worst case for anything that rescans its buffer
+            data = workload(64 * 1024)
+            chunks = chunked(data, 1)
+
+            def run():
+                stream = telneter.TelnetStream()
+                for chunk in chunks:
+                    stream.receive_data(chunk)
+            return run, len(data), 'bytes'
+        register_benchmark('receive_data.%s.1b' % workload_name)(fragmented)
+
+
+_register_parsers()
+
+
+@register_benchmark('receive_data.mud.4k.instrumented')
+def bench_instrumented():
+    ''' receive_data.mud.4k with TelnetStream.instrument(), the plain one is the cost when it's off '''
+    chunks = chunked(mud_text(1024 * 1024), 4096)
+
+    def run():
+        stream = telneter.TelnetStream()
+        stream.instrument(None)
+        for chunk in chunks:
+            stream.receive_data(chunk)
+    return run, len(chunks) * 4096, 'bytes'
+
+
+def _bench_gmcp(name):
+    ''' receive_data with somebody subscribed to GMCP name, the vitals repeat so they are memoized '''
+    chunks = chunked(gmcp_stream(1024 * 1024), 4096)
+
+    def callback(tstate, name, value):
+        pass
+
+    def run():
+        stream = telneter.TelnetStream()
+        stream.state.subscribe(GMCP, name, callback)
+        for chunk in chunks:
+            stream.receive_data(chunk)
+    return run, len(chunks) * 4096, 'bytes'
+
+
+@register_benchmark('subscribe.gmcp.4k')
+def bench_gmcp():
+    return _bench_gmcp('Char')
+
+
+@register_benchmark('subscribe.gmcp.4k.unwanted')
+def bench_gmcp_unwanted():
+    ''' nobody wants what the server sends '''
+    return _bench_gmcp('Comm.Channel')
+
+
+def _bench_pool(workers, sessions=64):
+    ''' mud text in 4k chunks to lots of sessions, one chunk each per batch. workers=None runs
+        the same sessions in this process, the difference is what the pool costs
+    '''
+    chunks = chunked(mud_text(256 * 1024), 4096)
+
+    def run():
+        if workers is None:
+            streams = [telneter.TelnetStream() for conn_id in range(sessions)]
+            for chunk in chunks:
+                for stream in streams:
+                    stream.feed(chunk)
+                    del stream.outbuf[:]
+            return
+        with telneter_pool.SessionPool(workers) as pool:
+            for chunk in chunks:
+                pool.feed([(conn_id, chunk) for conn_id in range(sessions)])
+    return run, len(chunks) * 4096 * sessions, 'bytes'
+
+
+def _register_pools():
+    register_benchmark('pool.mud.4k.inprocess')(lambda: _bench_pool(None))
+    for workers in sorted(set([1, telneter_pool.default_workers()])):
+        register_benchmark('pool.mud.4k.%dworkers' % workers)(lambda workers=workers: _bench_pool(workers))
+
+
+_register_pools()
+
+
+@register_benchmark('read_lines.mud.4k')
+def bench_lines():
+    ''' receive_data with the text put together into lines '''
+    chunks = chunked(mud_text(1024 * 1024), 4096)
+
+    def run():
+        stream = telneter.TelnetStream()
+        stream.assemble_lines()
+        for chunk in chunks:
+            stream.receive_data(chunk)
+            stream.read_lines()
+    return run, len(chunks) * 4096, 'bytes'
+
+
+@register_benchmark('read_lines.mud.4k.utf8')
+def bench_lines_utf8():
+    chunks = chunked(mud_text(1024 * 1024), 4096)
+
+    def run():
+        stream = telneter.TelnetStream()
+        stream.assemble_lines('utf-8')
+        for chunk in chunks:
+            stream.receive_data(chunk)
+            stream.read_lines()
+    return run, len(chunks) * 4096, 'bytes'
+
+
+# how long clients that can't see GA/EOR wait for the rest of a line before calling it a prompt
+PROMPT_TIMEOUT = 0.05
+
+
+def _time_to_prompt(send_ga, prompts=10):
+    ''' a client sends a command and waits for the prompt after the reply, over a real socket '''
+    room = b'The Dusty Road\r\nA long road stretches east and west.\r\nExits: east west\r\n'
+
+    async def serve(protocol):
+        while True:
+            event = await protocol.read_event()
+            if event is None:
+                break
+            if event.__class__ is telneter.TextEvent:
+                protocol.write(room)
+                if send_ga:
+                    protocol.write_prompt(b'hp 100 > ')
+                else:
+                    protocol.write(b'hp 100 > ')
+
+    async def client(port):
+        protocol = await telneter_aio.open_connection('127.0.0.1', port, telneter.TelnetStream())
+        text = protocol.stream.assemble_lines()
+        for i in range(prompts):
+            protocol.write(b'look\r\n')
+            while True:
+                if send_ga:
+                    event = await protocol.read_event()
+                    if event.__class__ is telneter.PromptEvent:
+                        break
+                else:
+                    try:
+                        await asyncio.wait_for(protocol.read_event(), PROMPT_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        text.end_prompt()  # nothing for a while, so it must be a prompt
+                        break
+        protocol.close()
+
+    async def main():
+        server = await telneter_aio.start_server(serve, '127.0.0.1', 0, stream_factory=telneter.TelnetStream)
+        await client(server.sockets[0].getsockname()[1])
+        server.close()
+        await server.wait_closed()
+
+    def run():
+        asyncio.run(main())
+    return run, prompts, 'prompts'
+
+
+@register_benchmark('time_to_prompt.ga')
+def bench_prompt_ga():
+    ''' prompts per second when the server ends them with IAC GA, 1/x is the time to each prompt '''
+    return _time_to_prompt(True, prompts=200)
+
+
+@register_benchmark('time_to_prompt.timeout')
+def bench_prompt_timeout():
+    ''' the same without GA, the client waits PROMPT_TIMEOUT for more text '''
+    return _time_to_prompt(False)
+
+
+def nop_handler(tstate, cmd, option, sb_data):
+    return b''
+
+
+def _bench_dispatch(custom):
+    ''' recieve_command with handlers that do nothing, so we only time dispatch '''
+    telneter.register_handlers('bench', {'default': nop_handler, ECHO: nop_handler, telneter.AYT: nop_handler})
+    tstate = telneter.TelnetState(history_size=0, handlers='bench')
+    if custom:
+        tstate.set_handler(ECHO, lambda tstate, cmd, option, sb_data: b'')
+    tstate.options[ECHO] = DO  # so WILL ECHO is redundant
+    commands = [(WILL, ECHO, b''), (WONT, ECHO, b''), (DO, STATUS, b''), (NOP, None, b''),
+                (WILL, NAWS, b''), (DONT, TTYPE, b''), (SB, STATUS, b'x')] * 1000
+    recieve_command = tstate.recieve_command
+
+    def run():
+        for cmd, option, sb_data in commands:
+            recieve_command(cmd, option, sb_data)
+    return run, len(commands), 'commands'
+
+
+@register_benchmark('recieve_command.dispatch')
+def bench_dispatch():
+    return _bench_dispatch(False)
+
+
+@register_benchmark('recieve_command.dispatch.custom')
+def bench_dispatch_custom():
+    ''' a session that set_handler()ed its own ECHO handler '''
+    return _bench_dispatch(True)
+
+
+@register_benchmark('recieve_command.smart')
+def bench_smart_commands():
+    ''' recieve_command with the real handlers and history '''
+    commands = [(WILL, ECHO, b''), (WONT, ECHO, b''), (DO, STATUS, b''), (NOP, None, b''),
+                (WILL, NAWS, b''), (DONT, TTYPE, b''), (SB, STATUS, b'x')] * 1000
+
+    def run():
+        recieve_command = telneter.TelnetState.make_smartstate().recieve_command
+        for cmd, option, sb_data in commands:
+            recieve_command(cmd, option, sb_data)
+    return run, len(commands), 'commands'
+
+
+@register_benchmark('recieve_commands.burst')
+def bench_burst():
+    ''' a fresh session answering the pile of negotiations a client sends when it connects '''
+    burst = [(WILL, ECHO, b''), (DO, STATUS, b''), (WILL, NAWS, b''), (WILL, TTYPE, b''),
+             (DO, telneter.SGA, b''), (WILL, telneter.TELOPT_EOR, b''), (WILL, telneter.MCCP2, b''),
+             (DO, GMCP, b'')]
+    sessions = 1000
+
+    def run():
+        for i in range(sessions):
+            telneter.TelnetState.make_smartstate().recieve_commands(burst)
+    return run, sessions * len(burst), 'commands'
+
+
+@register_benchmark('construct_status.full')
+def bench_status():
+    ''' STATUS with every option set '''
+    tstate = telneter.TelnetState(history_size=0)
+    for option in telneter.BYTES:
+        tstate.options[option] = WILL
+
+    def run():
+        for i in range(100):
+            tstate.construct_status()
+    return run, 100, 'replies'
+
+
+def _live_session():
+    ''' a server session partway through a GMCP payload, with some negotiation done and output queued '''
+    stream = telneter.TelnetStream.make_server()
+    stream.receive_data(IAC+DO+telneter.MCCP3 + IAC+DONT+telneter.MCCP2 + IAC+WILL+NAWS + IAC+DO+GMCP +
+                        IAC+SB+GMCP + b'Core.Hello {"client": "bench"')
+    stream.send_text(b'Welcome!\r\n')
+    return stream
+
+
+@register_benchmark('snapshot')
+def bench_snapshot():
+    stream = _live_session()
+
+    def run():
+        for i in range(1000):
+            stream.snapshot()
+    run.extra = {'bytes': len(stream.snapshot())}
+    return run, 1000, 'snapshots'
+
+
+@register_benchmark('restore')
+def bench_restore():
+    snapshot = _live_session().snapshot()
+    restore = telneter.TelnetStream.restore
+
+    def run():
+        for i in range(1000):
+            restore(snapshot)
+    run.extra = {'bytes': len(snapshot)}
+    return run, 1000, 'restores'
+
+
+@register_benchmark('import')
+def bench_import():
+    ''' a fresh interpreter importing telneter, less the time for an empty interpreter '''
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)  # time the import, not compiling it
+
+    def python(code):
+        subprocess.check_call([sys.executable, '-c', code], env=env)
+    python('import telneter')
+    empty = min(timeit.repeat(lambda: python('pass'), number=1, repeat=5))
+
+    def run():
+        python('import telneter')
+    run.overhead = empty  # run_benchmark takes this off every timing
+    return run, 1, 'imports'
+
+
+def register_trace(path):
+    ''' a benchmark that replays a capture file made with telneter_capture, named replay.<file name> '''
+    name = 'replay.' + os.path.splitext(os.path.basename(path))[0]
+
+    def bench():
+        capture = telneter_capture.Capture(path)
+        chunks = [data for when, data in capture.chunks()]
+        capture.close()
+
+        def run():
+            stream = telneter.TelnetStream()
+            for chunk in chunks:
+                stream.receive_data(chunk)
+        return run, sum(map(len, chunks)), 'bytes'
+    register_benchmark(name)(bench)
+    return name
+
+
+# running
+
+def run_benchmark(name, repeat):
+    run, amount, unit = all_benchmarks[name]()
+    overhead = getattr(run, 'overhead', 0)
+    run()  # warm up
+    times = [max(t - overhead, 1e-9) for t in timeit.repeat(run, number=1, repeat=repeat)]
+    rates = sorted(amount / t for t in times)
+    if unit == 'bytes':
+        rates = [rate / (1024 * 1024) for rate in rates]
+        unit = 'MB'
+    return {
+        'extra': getattr(run, 'extra', {}),  # anything else worth knowing, e.g. sizes
+        'unit': unit + '/sec',
+        'median': statistics.median(rates),
+        'p10': percentile(rates, 10),
+        'p90': percentile(rates, 90),
+        'samples': rates,
+    }
+
+
+def run_all(names, repeat, out=sys.stdout):
+    results = {}
+    for name in names:
+        result = results[name] = run_benchmark(name, repeat)
+        extra = ''.join(['  %s %s' % item for item in sorted(result['extra'].items())])
+        print('%-40s %12.1f %-13s p10 %12.1f p90 %12.1f%s' % (
+            name, result['median'], result['unit'], result['p10'], result['p90'], extra), file=out)
+    return results
+
+
+def compare(results, baseline, max_drop):
+    ''' return a list of (name, baseline median, new median) for everything that got too slow '''
+    regressions = []
+    for name, result in sorted(results.items()):
+        if name not in baseline:
+            continue
+        before = baseline[name]['median']
+        after = result['median']
+        if after < before * (1 - max_drop / 100.0):
+            regressions.append((name, before, after))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='telneter benchmarks')
+    parser.add_argument('-k', dest='pattern', default='', help='only run benchmarks with this in their name')
+    parser.add_argument('--repeat', type=int, default=7, help='timings per benchmark')
+    parser.add_argument('--save', help='write the results to this JSON file')
+    parser.add_argument('--compare', help='a JSON file from --save to compare against')
+    parser.add_argument('--max-drop', type=float, default=20, help='percent slowdown that fails --compare')
+    parser.add_argument('--trace', action='append', default=[], help='also benchmark replaying this capture file')
+    args = parser.parse_args(argv)
+    for path in args.trace:
+        register_trace(path)
+
+    baseline = None
+    names = sorted(name for name in all_benchmarks if args.pattern in name)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+        if not args.pattern:
+            names = [name for name in names if name in baseline]
+
+    results = run_all(names, args.repeat)
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'results': results}, f, indent=2, sort_keys=True)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.max_drop)
+        for name, before, after in regressions:
+            print('REGRESSION %s: %.1f -> %.1f (%.0f%% slower)' % (
+                name, before, after, 100 * (1 - after / before)))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -21,12 +21,16 @@ But there was unittest that passed in a 1meg string and took 99% of the time
 for the whole suite; so I wrote these to get that test down to ~0ms.
 '''
 
-from __future__ import print_function
-
-from itertools import izip
 import re
 import time
-from telnetlib import IAC, SB, SE, STATUS
+
+# optional and only find_numpy wants it, so it is imported the first time that is
+# called rather than slowing down every import of telneter. None if it isn't installed
+numpy = False
+
+IAC, SB, SE, STATUS = b'\xff', b'\xfa', b'\xf0', b'\x05'
+# indexing a bytestring gives ints
+IAC_I, SE_I = ord(IAC), ord(SE)
 
 
 all_finders = []
@@ -54,10 +58,10 @@ def find_simple(data):
     i = 0
     try:
         while True:
-            if data[i] == IAC:
-                if data[i+1] == SE:
+            if data[i] == IAC_I:
+                if data[i+1] == SE_I:
                     return i  # found it!
-                elif data[i+1] == IAC:  # escaped IAC
+                elif data[i+1] == IAC_I:  # escaped IAC
                     i += 2
                 else:
                     i += 1
@@ -73,9 +77,9 @@ def find_simple2(data):
     iacs = 0
     try:
         while True:
-            if iacs % 2 and data[i] == SE:
+            if iacs % 2 and data[i] == SE_I:
                 return i-1
-            elif data[i] == IAC:
+            elif data[i] == IAC_I:
                 iacs += 1
             else:
                 iacs = 0
@@ -95,7 +99,7 @@ def find_simple3(data):
     try:
         while iacse_i >= 0:
             end = i = iacse_i - 1
-            while data[i] == IAC:
+            while data[i] == IAC_I:
                 i -= 1
             if not (end - i) % 2:  # even number of preceding IACS
                 return iacse_i
@@ -110,7 +114,8 @@ def find_simple3(data):
 def find_regexp(haystack):
     # regexps speed things up, but not enough. ~25ms on a 1M string.
     # not an IAC followed by zero or an even number of IACs followed by IAC+SE
-    want = re.compile('(?<!%s)(%s%s)*(%s%s)' % (IAC, IAC, IAC, IAC, SE))
+    iac, se = re.escape(IAC), re.escape(SE)
+    want = re.compile(b'(?<!' + iac + b')(' + iac + iac + b')*(' + iac + se + b')')
     m = want.search(haystack)
     if not m:
         return -1
@@ -120,7 +125,7 @@ def find_regexp(haystack):
 @register_finder
 def find_regexp2(haystack):
     # regexps speed things up, but not enough. ~25ms on a 1M string.
-    want = re.compile('%s+%s' % (IAC, SE))
+    want = re.compile(re.escape(IAC) + b'+' + re.escape(SE))
     m = None
     for m in want.finditer(haystack):
         if (m.end() - m.start()) % 2 == 0:  # even number of chars
@@ -129,18 +134,20 @@ def find_regexp2(haystack):
 
 
 @register_finder
-def find_find(haystack):
+def find_find(haystack, start=0, end=None):
     # simple bytes.find() works pretty well for the normal case. ~1ms on a 1M string.
-    iaciac_i = haystack.find(IAC+IAC)
-    iacse_i = haystack.find(IAC+SE)
+    if end is None:
+        end = len(haystack)
+    iaciac_i = haystack.find(IAC+IAC, start, end)
+    iacse_i = haystack.find(IAC+SE, start, end)
 
     while iacse_i != -1:
         if iaciac_i == -1 or iaciac_i > iacse_i:
             break
         if iaciac_i+2 <= iacse_i:
-            iaciac_i = haystack.find(IAC+IAC, iaciac_i+2)
+            iaciac_i = haystack.find(IAC+IAC, iaciac_i+2, end)
         else:
-            iacse_i = haystack.find(IAC+SE, iacse_i+2)
+            iacse_i = haystack.find(IAC+SE, iacse_i+2, end)
     return iacse_i
 
 
@@ -188,8 +195,8 @@ def find_rfind(haystack):
 
         # odd number of IACs followed by SE means the IAC+SE is good
         # even number of IACs followed by SE means the IACs are all escaped
-        if (iaciac_j == -1 or  # decremented by two from 1 to -1, only one IAC
-            haystack[iaciac_j:iaciac_j+2].count(IAC) == 1):
+        # (the byte at iaciac_j may be the IAC of an earlier IAC+SE, only the one after it counts)
+        if haystack[iaciac_j+1:iaciac_j+2] == IAC:
             return iacse_i
         # it was an even numbered block of IACS (i.e. all escaped)
         iaciac_pairs |= maybe_iaciac_pairs
@@ -208,10 +215,17 @@ def find_rfind(haystack):
 
 
 @register_finder
-def find_replace(data):
+def find_replace(data, start=0, end=None):
     ''' extremely simple and fast search (at the expense of a full in memory copy) '''
-    ndata = data.replace(IAC+IAC, ':)')
-    return ndata.find(IAC+SE)
+    if end is None:
+        end = len(data)
+    if start or end != len(data) or isinstance(data, memoryview):
+        data = bytes(data[start:end])
+    ndata = data.replace(IAC+IAC, b':)')
+    i = ndata.find(IAC+SE)
+    if i == -1:
+        return -1
+    return start + i
 
 
 @register_finder
@@ -220,31 +234,164 @@ def find_itertools(data):
     it2 = iter(data)
     try:
         next(it2)
-        enumerated_pairs = enumerate(izip(it1, it2))
+        enumerated_pairs = enumerate(zip(it1, it2))
         for i, pair in enumerated_pairs:
-            if pair == (IAC, IAC):
+            if pair == (IAC_I, IAC_I):
                 # skip ahead an extra byte each to avoid IAC+IAC+SE
                 next(enumerated_pairs)
-            elif pair == (IAC, SE):
+            elif pair == (IAC_I, SE_I):
                 return i
     except StopIteration:
         pass
     return -1
 
 
+_IAC_runs = re.compile(re.escape(IAC) + b'+(' + re.escape(SE) + b')?')
+
+
+@register_finder
+def find_runs(haystack, start=0, end=None):
+    # one regexp match per run of IACs, so it is linear even for long runs that
+    # make find_regexp2 backtrack. re searches memoryviews without a copy.
+    if end is None:
+        end = len(haystack)
+    for m in _IAC_runs.finditer(haystack, start, end):
+        # IAC+SE with an even length means an odd number of IACs before the SE
+        if m.group(1) and (m.end() - m.start()) % 2 == 0:
+            return m.end() - 2
+    return -1
+
+
+# how many IAC IAC pairs AdaptiveFinder skips one at a time before giving up on find()
+MAX_REJECTED = 100
+# searches below this size are never worth a copy
+SMALL_SEARCH = 256
+# after a hostile looking payload, how many big searches go straight to find_replace
+HOSTILE_SEARCHES = 64
+
+
+class AdaptiveFinder(object):
+    ''' find IAC+SE, picking the strategy from what the data looks like.
+
+        The common case is an SB payload without any IAC IAC in it, that is one
+        or two bytes.find()s and no copying (find_find). Each IAC IAC before a
+        candidate IAC+SE costs a trip around a python loop, so after MAX_REJECTED
+        of those we switch to find_replace, which copies but is linear at C speed.
+        That decision sticks for the next HOSTILE_SEARCHES big searches, so keep
+        one of these per stream.
+        memoryviews don't have find(), they use find_runs.
+    '''
+    __slots__ = ('hostile',)
+
+    def __init__(self):
+        self.hostile = 0
+
+    def __call__(self, data, start=0, end=None):
+        if end is None:
+            end = len(data)
+        if isinstance(data, memoryview):
+            return find_runs(data, start, end)
+        if self.hostile and end - start > SMALL_SEARCH:
+            self.hostile -= 1
+            return find_replace(data, start, end)
+
+        # most payloads have no IACs, or the first one is the IAC+SE.
+        # finding one byte is a lot quicker than finding two
+        i = data.find(IAC, start, end)
+        if i == -1 or i + 1 == end:
+            return -1
+        if data[i+1] == SE_I:
+            return i
+
+        # find_find, counting the candidates it rejects
+        iaciac_i = data.find(IAC+IAC, i, end)
+        iacse_i = data.find(IAC+SE, i, end)
+        rejected = 0
+        while iacse_i != -1:
+            if iaciac_i == -1 or iaciac_i > iacse_i:
+                break
+            rejected += 1
+            if rejected > MAX_REJECTED:
+                self.hostile = HOSTILE_SEARCHES
+                # iaciac_i is where the pairs still need counting
+                return find_replace(data, iaciac_i, end)
+            if iaciac_i+2 <= iacse_i:
+                iaciac_i = data.find(IAC+IAC, iaciac_i+2, end)
+            else:
+                iacse_i = data.find(IAC+SE, iacse_i+2, end)
+        return iacse_i
+
+
+@register_finder
+def find_adaptive(haystack):
+    return AdaptiveFinder()(haystack)
+
+
+@register_finder
+def find_numpy(haystack, start=0, end=None):
+    ''' count the IAC runs with array operations instead of a loop.
+        A few ms per megabyte whatever is in it, and the quickest of the lot for
+        long runs of IACs. But it costs ~40us just to set up the arrays, and lots
+        of short runs are no quicker than find_replace, so AdaptiveFinder doesn't use it.
+        numpy is optional, without it this is AdaptiveFinder.
+    '''
+    global numpy
+    if end is None:
+        end = len(haystack)
+    if numpy is False:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+    if numpy is None:
+        return AdaptiveFinder()(haystack, start, end)
+    data = numpy.frombuffer(haystack, dtype=numpy.uint8, count=end - start, offset=start)
+    # where the IAC runs start and end, as alternating offsets
+    bounds = numpy.flatnonzero(numpy.diff(data == IAC_I, prepend=False, append=False))
+    starts, ends = bounds[::2], bounds[1::2]
+    if len(ends) and ends[-1] == len(data):  # a run at the very end isn't followed by anything
+        starts, ends = starts[:-1], ends[:-1]
+    # an odd run followed by SE is the IAC+SE we want
+    found = numpy.flatnonzero((data[ends] == SE_I) & ((ends - starts) % 2 == 1))
+    if not len(found):
+        return -1
+    return start + int(ends[found[0]]) - 1
+
+
+def regression_blobs(size=1024 * 1024):
+    ''' the SB payloads that have made finders slow, as [(short name, blob)] '''
+    return [
+        ('xxxxxx', b'x' * size),
+        ('xxxxII', (b'xxxxxx' + IAC + IAC) * (size // 8)),
+        ('IIIIII', (IAC+IAC) * (size // 2)),
+        ('IISIIS', (b'xxxxx' + IAC + IAC + SE) * (size // 8)),
+        ('SSSSSS', SE * size),
+    ]
+
+
+def cross_check(blobs=None):
+    ''' run every registered finder over the regression blobs and some awkward
+        small cases, raise AssertionError if any of them disagree
+    '''
+    if blobs is None:
+        blobs = [blob for _, blob in regression_blobs(4096)]
+    payloads = [IAC+SB+STATUS + blob + IAC+SE for blob in blobs]
+    payloads += [
+        b'', IAC, IAC+SE, IAC+IAC+SE, IAC+IAC+IAC+SE, b'x' + IAC+SE + IAC+SE,
+        IAC+IAC + b'x' + IAC+SE, (IAC+IAC+SE) * 200 + IAC+SE, IAC * 301 + SE,
+        (IAC * 7 + b'x') * 50 + IAC * 2 + SE,
+    ]
+    for payload in payloads:
+        answers = [(func.__name__, func(payload)) for func in all_finders]
+        assert len(set(ans for _, ans in answers)) == 1, (payload[:20], answers)
+
+
 def speed_regressions():
     # for large SB payloads it is easy to do a very bad & slow parse
     # this test compares all the IAC+SE parsers.
-    
-    SIZE = 1024
-    big_plain = 'x' * 1024 * SIZE
-    big_iacs = ('xxxxxx' + IAC + IAC) * 128 * SIZE
-    all_iacs = (IAC+IAC) * 512 * SIZE
-    fake_iacses = ('xxxxx' + IAC + IAC + SE) * 128 * SIZE
-    all_ses = SE*1024*SIZE
-    blobs = [big_plain, big_iacs, all_iacs, fake_iacses, all_ses]
-
-    print(map(len, blobs))
+    names, blobs = zip(*regression_blobs())
+
+    print([len(blob) for blob in blobs])
     results = []
     answers = []
     for func in all_finders:
@@ -260,12 +407,10 @@ def speed_regressions():
         answers.append(answer_row)
 
     correct = answers[0]
-    i = 1
     for also_correct in answers[1:]:
-        i += 1
         assert correct == also_correct, (correct, also_correct)
 
-    print(' ' * 18, ''.join(['\txxxxxx', '\txxxxII', '\tIIIIII', '\tIISIIS', '\tSSSSSS']))
+    print(' ' * 18, ''.join('\t' + name for name in names))
     for func, times in zip(all_finders, results):
         print(func.__name__.ljust(20, ' '), ''.join(times))
 
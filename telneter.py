@@ -1,31 +1,77 @@
 ''' Parse telnet streams and keep telnet session state '''
 
+import codecs
+import json
 import re
+import struct
+import time
+import weakref
+import zlib
+from collections import namedtuple
+from types import MappingProxyType
+
 import find_IACSE
-# import some telnet negotiation constants
-from telnetlib import IAC, DONT, DO, WONT, WILL, SE, NOP, GA, SGA, SB, ECHO, EOR, AYT, NAWS, TTYPE, STATUS
-TELOPT_EOR = chr(239)
-# a couple standard ones used in TTYPE
-SEND = chr(1)
-IS = chr(0)
-# and define some non-official ones
-MCCP2 = chr(86)  # Mud Compression Protocol, v2
-MCCP1 = chr(85)  # Mud Compression Protocol, v1 (broken and not supported here)
-MSP = chr(90) # Mud Sound Protocol
-MXP = chr(91) # Mud eXtension Protocol
-
-val_to_name = {}
-for k, v in locals().items():
-    try:
-        if 0 <= ord(v) <= 255:
-            val_to_name[v] = k
-    except (ValueError, TypeError):
-        pass
-val_to_name[ECHO] = 'ECHO'  # TODO, double check 'SEND' == 0x01
+
+# one byte bytestrings for every value, BYTES[255] == b'\xff'
+BYTES = [bytes((i,)) for i in range(256)]
+
+# the telnet constants we know about, as (name, value).
+# (these used to come from telnetlib, which python 3.13 doesn't have)
+CONSTANTS = [
+    # a couple standard ones used in TTYPE
+    ('SEND', 1),
+    ('IS', 0),
+    # commands, RFC 854 and RFC 885
+    ('SE', 240),  # end of subnegotiation
+    ('NOP', 241),
+    ('DM', 242),  # data mark
+    ('BRK', 243),  # break
+    ('IP', 244),  # interrupt process
+    ('AO', 245),  # abort output
+    ('AYT', 246),  # are you there
+    ('EC', 247),  # erase character
+    ('EL', 248),  # erase line
+    ('GA', 249),  # go ahead
+    ('SB', 250),  # subnegotiation begin
+    ('WILL', 251),
+    ('WONT', 252),
+    ('DO', 253),
+    ('DONT', 254),
+    ('IAC', 255),  # interpret as command
+    ('EOR', 239),  # end of record
+    # options
+    ('ECHO', 1),
+    ('SGA', 3),  # suppress go ahead
+    ('STATUS', 5),
+    ('TTYPE', 24),  # terminal type
+    ('TELOPT_EOR', 25),  # end of record
+    ('NAWS', 31),  # negotiate about window size
+    # and some non-official ones
+    ('MCCP1', 85),  # Mud Compression Protocol, v1 (broken and not supported here)
+    ('MCCP2', 86),  # Mud Compression Protocol, v2
+    ('MCCP3', 87),  # Mud Compression Protocol, v3 (client to server)
+    ('MSP', 90),  # Mud Sound Protocol
+    ('MXP', 91),  # Mud eXtension Protocol
+    ('MSDP', 69),  # Mud Server Data Protocol
+    ('GMCP', 201),  # Generic Mud Communication Protocol
+]
+
+SEND, IS = BYTES[1], BYTES[0]
+SE, NOP, DM, BRK, IP, AO, AYT, EC, EL, GA, SB, WILL, WONT, DO, DONT, IAC = BYTES[240:256]
+EOR = BYTES[239]
+ECHO, SGA, STATUS, TTYPE, TELOPT_EOR, NAWS = BYTES[1], BYTES[3], BYTES[5], BYTES[24], BYTES[25], BYTES[31]
+MCCP1, MCCP2, MCCP3, MSP, MXP = BYTES[85], BYTES[86], BYTES[87], BYTES[90], BYTES[91]
+MSDP, GMCP = BYTES[69], BYTES[201]
+# the bytes MSDP payloads are built from, not in CONSTANTS because they would shadow ECHO and friends
+MSDP_VAR, MSDP_VAL, MSDP_TABLE_OPEN, MSDP_TABLE_CLOSE, MSDP_ARRAY_OPEN, MSDP_ARRAY_CLOSE = BYTES[1:7]
+
+# later names win, so ECHO beats SEND
+val_to_name = dict((BYTES[value], name) for name, value in CONSTANTS)
+assert all(globals()[name] == BYTES[value] for name, value in CONSTANTS)
 
 def clean_data(data):
     """ the old telnetlib does this, I'm not sure why """
-    return data.replace(chr(0),'').replace('\021', '')
+    return data.translate(None, b'\0\021')
 
 
 # TODO: rename IAC_escape to plain escape()?
@@ -34,11 +80,33 @@ def IAC_escape(data):
     return data.replace(IAC, IAC+IAC)
 
 
+# every IAC <cmd> <option> we might send, REPLIES[DO][ECHO] == IAC+DO+ECHO.
+# read-only because every session shares it
+REPLIES = MappingProxyType(dict(
+    (cmd, MappingProxyType(dict((option, IAC + cmd + option) for option in BYTES)))
+    for cmd in (WILL, WONT, DO, DONT)))
+
+# SB frames we send often enough to keep around, keyed by (option, sb_data)
+SB_FRAMES = MappingProxyType(dict(((option, sb_data), IAC + SB + option + sb_data + IAC + SE) for option, sb_data in [
+    (MCCP2, b''),  # start compressing
+    (MCCP3, b''),
+    (TTYPE, SEND),
+    (STATUS, SEND),
+]))
+
+
 def construct_control(cmd, option=b'', sb_data=b''):
     if cmd != SB:
         if sb_data:
             raise ValueError("Don't know how to construct an %r command with a payload" % cmd)
+        replies = REPLIES.get(cmd)
+        if replies is not None and option in replies:
+            return replies[option]
         return IAC + cmd + option
+    if len(sb_data) <= 1:
+        frame = SB_FRAMES.get((option, bytes(sb_data)))
+        if frame is not None:
+            return frame
     return IAC + SB + option + IAC_escape(sb_data) + IAC + SE
 
 
@@ -60,51 +128,468 @@ def parse(data):
 
 
 def partition_control(data):
-    ''' split data into <text>, and <rest> where <rest> is possibly a control sequence '''
-
-    # cool story: in CPython if the string to be replaced doesn't exist then
-    # it skips the copy. So don't manually do our own find(IAC) here.
-
-    # search with the IACIACs removed
-    plain = data.replace(IAC+IAC, ':)')
-    iac_i = plain.find(IAC)
-    if iac_i == -1:
-        return data.replace(IAC+IAC, IAC), b''
-
-    return data[:iac_i], data[iac_i:]
+    ''' split data into <text>, and <rest> where <rest> is possibly a control sequence.
+        data may be a bytestring, bytearray, or memoryview. For a memoryview the
+        text and rest are views into it, unless the text had IACs to unescape.
+    '''
+    i, escaped = partition_control_range(data)
+    text = data[:i]
+    if escaped:
+        text = unescape(text)
+    return text, data[i:]
 
 
 def parse_control(data):
     ''' data must start with an IAC sequence.
         return ((cmd, option, sb_data), unparsed_data)
     '''
-    assert data[0] == IAC
+    assert data[0:1] == IAC
     # okie, we have an IAC at position zero.  do some work.
-    # we index blindly through the array, if we get an IndexError we have
-    # a partial IAC sequence, just return and we'll try it again when we have more data
-    try:
-        cmd = data[1]
-        option = data[2]
-    except IndexError: 
+    found = parse_control_range(data)
+    if found is None:
         # we didn't have the full IAC sequence, try again later
         return None, data
 
+    cmd, option, sb_start, sb_end, escaped, next_i = found
     if cmd != SB:
-        unparsed = data[3:]
-        return (cmd, option, b''), unparsed
+        return (cmd, option, b''), data[next_i:]
+
+    # IAC SB OPTION <data> IAC SE
+    sb_data = data[sb_start:sb_end]
+    if escaped:
+        sb_data = unescape(sb_data)
+    return (cmd, option, sb_data), data[next_i:]
+
 
-    # search with the IACIACs removed
-    plain = data.replace(IAC+IAC, ':)')
-    i = plain.find(IAC+SE)
+def partition_control_range(data, start=0, end=None):
+    ''' like partition_control() but return offsets into data instead of copies.
+        return (i, escaped) where data[start:i] is text and data[i:end] is possibly a control sequence.
+        escaped is True if the text has IAC IACs in it that need unescaping.
+    '''
+    if end is None:
+        end = len(data)
+    find = _IAC_finder(data)
+    escaped = False
+    i = find(start, end)
+    while i != -1:
+        if i + 1 == end or _byte_at(data, i + 1) != IAC:
+            return i, escaped
+        escaped = True
+        i = find(i + 2, end)
+    return end, escaped
+
+
+def parse_control_range(data, start=0, end=None, finder=None):
+    ''' like parse_control() but return offsets into data instead of copies.
+        data[start] must be an IAC.
+        return None if the control sequence is incomplete, otherwise
+        (cmd, option, sb_start, sb_end, escaped, next_i) where data[sb_start:sb_end]
+        is the SB payload (empty for other commands) and escaped is True if it
+        has IACs in it that may need unescaping. Like TelnetParser only SB and
+        WILL/WONT/DO/DONT have an option, the rest (e.g. IAC NOP) are two bytes
+        and their option is None.
+        finder is the find_IACSE.AdaptiveFinder to use, pass your own to keep
+        its decisions to yourself.
+    '''
+    if end is None:
+        end = len(data)
+    if start + 2 > end:
+        return None
+    cmd = _byte_at(data, start + 1)
+    if cmd != SB and cmd not in NEGOTIATIONS:
+        return cmd, None, start + 2, start + 2, False, start + 2
+    if start + 3 > end:
+        return None
+    option = _byte_at(data, start + 2)
+    if cmd != SB:
+        return cmd, option, start + 3, start + 3, False, start + 3
+
+    if finder is None:
+        finder = _find_IACSE
+    i = finder(data, start + 3, end)
     if i == -1:
         # no terminator, try again later
-        return None, data
+        return None
+    escaped = _IAC_finder(data)(start + 3, i) != -1
+    return cmd, option, start + 3, i, escaped, i + 2
 
-    # IAC SB OPTION <data> IAC SE
-    sb_data = data[3:i]
-    sb_data = sb_data.replace(IAC+IAC, IAC)
-    unparsed = data[i+2:]
-    return (cmd, option, sb_data), unparsed
+
+def unescape(data):
+    ''' undo IAC_escape(), only makes a copy if there was an escaped IAC '''
+    if isinstance(data, memoryview):
+        data = data.tobytes()
+    if data.find(IAC) == -1 or data.find(IAC+IAC) == -1:  # one byte finds are quicker
+        return data
+    return data.replace(IAC+IAC, IAC)
+
+
+def _byte_at(data, i):
+    ''' return data[i] as a one byte bytestring, whatever kind of buffer data is '''
+    byte = data[i:i+1]
+    if isinstance(byte, memoryview):
+        return byte.tobytes()
+    return bytes(byte)
+
+
+_search_IAC = re.compile(re.escape(IAC)).search
+
+
+# for parse_control(), TelnetParser has one of its own
+_find_IACSE = find_IACSE.AdaptiveFinder()
+
+
+def _IAC_finder(data):
+    ''' return a find(start, end) function for IACs in data that doesn't copy data '''
+    if isinstance(data, memoryview):
+        def find_view(start, end):
+            match = _search_IAC(data, start, end)
+            return match.start() if match else -1
+        return find_view
+
+    def find(start, end):
+        return data.find(IAC, start, end)
+    return find
+
+
+# events returned by TelnetParser and TelnetStream.feed()
+TextEvent = namedtuple('TextEvent', 'text')
+CommandEvent = namedtuple('CommandEvent', 'cmd option sb_data')
+# the pieces of a streamed subnegotiation, see TelnetParser.stream_subneg()
+SBStartEvent = namedtuple('SBStartEvent', 'option')
+SBChunkEvent = namedtuple('SBChunkEvent', 'option data')
+SBEndEvent = namedtuple('SBEndEvent', 'option')
+# an SB payload that grew past its limit, head is the start of it
+SBOverflowEvent = namedtuple('SBOverflowEvent', 'option head')
+# compressed data zlib couldn't inflate, error is zlib's message and head is the start of
+# the data, which is dropped. anything after it is parsed as plain telnet
+DecompressErrorEvent = namedtuple('DecompressErrorEvent', 'error head')
+# the text of a prompt, ended by IAC GA or IAC EOR. see TelnetStream.assemble_lines()
+PromptEvent = namedtuple('PromptEvent', 'text')
+
+
+def parse_all(data):
+    ''' Parse all of data in one pass.
+        return a list of TextEvent and CommandEvent tuples and the unparsed data.
+    '''
+    parser = TelnetParser()
+    events = list(parser.parse(data))
+    return events, parser.unparsed_data
+
+
+# most bytes to inflate at once when decompressing MCCP2
+MAX_INFLATE = 64 * 1024
+
+# biggest SB payload we buffer, unless TelnetParser.limit_subneg() says otherwise
+MAX_SB = 1024 * 1024
+# what to do with an SB payload that gets too big
+SB_DISCARD = 'discard'  # drop it, but skip everything up to its IAC SE
+SB_ABORT = 'abort'  # drop it and go back to parsing text right away
+# how much of an overflowing payload SBOverflowEvent keeps
+SB_HEAD = 64
+# SB limits that aren't limits: a streamed payload, and one that overflowed that we are skipping
+SB_STREAMING, SB_DROPPING = -1, -2
+# the limit for each option, indexed by its int
+SB_LIMITS = [MAX_SB] * 256
+
+# states for the resumable parser
+TEXT, COMMAND, OPTION, SB_OPTION, SB_DATA, SB_IAC, SB_ESCAPED = range(7)
+# commands that are always followed by an option byte
+NEGOTIATIONS = (WILL, WONT, DO, DONT)
+# ints for comparing against what we index out of the data
+IAC_I, SB_I, SE_I = ord(IAC), ord(SB), ord(SE)
+NEGOTIATIONS_I = frozenset(map(ord, NEGOTIATIONS))
+
+
+class TelnetParser(object):
+    ''' Resumable parser for a telnet stream.
+
+        Unlike parse() this keeps its place between calls: where we are in an
+        IAC sequence and the SB payload collected so far. Each byte is only
+        looked at once no matter how the stream is chunked, so a huge SB
+        delivered one byte at a time costs the same as one delivered whole.
+
+        Once an SB payload turns out to have escaped IACs in it the rest of it is
+        searched with a find_IACSE.AdaptiveFinder, so a payload full of IAC IACs
+        can't make us go around the loop for every byte.
+
+        SB payloads are buffered up to MAX_SB bytes, past that they are dropped and
+        we yield an SBOverflowEvent instead. limit_subneg() changes that for an option,
+        stream_subneg() has an option's payloads yielded in pieces as they arrive.
+        The limit is checked at the end of each chunk, so we never hold on to more
+        than the limit plus one chunk.
+
+        After start_decompression() everything is inflated before parsing, in
+        chunks of at most max_inflate bytes so a zlib bomb can't eat our memory.
+        Data zlib can't inflate stops the decompression and we yield a
+        DecompressErrorEvent, one bad byte doesn't wedge the parser for good.
+    '''
+    __slots__ = ('state', 'cmd', 'option', 'sb_buf', 'sb_limits', 'sb_overflows', 'sb_limit',
+                 'finder', 'decompressor', 'rest', 'max_inflate')
+
+    def __init__(self):
+        self.max_inflate = MAX_INFLATE
+        self.state = TEXT
+        self.cmd = None
+        self.option = None
+        # the SB payload so far, unescaped. one buffer rather than a list of pieces so
+        # a peer sending it a byte at a time can't make us hold more than its limit
+        self.sb_buf = bytearray()
+        # shared until limit_subneg() or stream_subneg() are called
+        self.sb_limits = SB_LIMITS
+        # {option: SB_ABORT}, the rest are SB_DISCARD
+        self.sb_overflows = None
+        # the limit for the SB we are in
+        self.sb_limit = MAX_SB
+        self.finder = find_IACSE.AdaptiveFinder()
+        self.decompressor = None
+        # plain data left over when compression starts in the middle of a chunk
+        self.rest = b''
+
+    def limit_subneg(self, option, max_size, overflow=SB_DISCARD):
+        ''' buffer at most max_size bytes of option's SB payloads, option None sets it
+            for every option. overflow is SB_DISCARD or SB_ABORT.
+        '''
+        if overflow not in (SB_DISCARD, SB_ABORT):
+            raise ValueError('overflow must be SB_DISCARD or SB_ABORT, not %r' % (overflow,))
+        if max_size < 0:
+            raise ValueError('max_size must be at least 0')
+        options = range(256) if option is None else [ord(option)]
+        self._set_sb_limit(options, max_size)
+        if self.sb_overflows is None:
+            self.sb_overflows = {}
+        for i in options:
+            if overflow == SB_ABORT:
+                self.sb_overflows[BYTES[i]] = SB_ABORT
+            else:
+                self.sb_overflows.pop(BYTES[i], None)
+
+    def stream_subneg(self, option):
+        ''' yield option's SB payloads as an SBStartEvent, an SBChunkEvent for each
+            piece we get and an SBEndEvent, rather than buffering the whole payload.
+        '''
+        self._set_sb_limit([ord(option)], SB_STREAMING)
+
+    def _set_sb_limit(self, options, limit):
+        if self.sb_limits is SB_LIMITS:
+            self.sb_limits = list(SB_LIMITS)
+        for i in options:
+            self.sb_limits[i] = limit
+
+    def start_decompression(self):
+        ''' inflate all data from here on, until the compressed stream ends '''
+        self.decompressor = zlib.decompressobj()
+
+    def parse(self, data):
+        ''' yield TextEvent and CommandEvent tuples in stream order (and the SB*Events, see
+            limit_subneg() and stream_subneg()).
+            Text is yielded as soon as we have it, partial control sequences are kept for next time.
+        '''
+        more = False
+        while data or more:
+            decompressor = self.decompressor
+            if decompressor is None:
+                for event in self._parse(data, False):
+                    yield event
+                data, self.rest = self.rest, b''
+                more = False
+                continue
+
+            try:
+                chunk = decompressor.decompress(data, self.max_inflate)
+            except zlib.error as e:
+                # there's no finding our place in a broken stream, drop what we were given
+                self.decompressor = None
+                yield DecompressErrorEvent(str(e), bytes(data[:SB_HEAD]))
+                data, more = b'', False
+                continue
+            data = decompressor.unconsumed_tail
+            # zlib may be holding on to more output even if all the input is used
+            more = len(chunk) == self.max_inflate
+            for event in self._parse(chunk, True):
+                yield event
+            if decompressor.unused_data or decompressor.eof:
+                # the server ended the compressed stream, the rest is plain telnet
+                self.decompressor = None
+                data = decompressor.unused_data
+                more = False
+
+    def _parse(self, data, compressed):
+        state = self.state
+        text = []
+        # where an SB payload that started in this chunk starts, until it has to go in
+        # sb_buf. most payloads start and end in one chunk, those are a single slice
+        sb_start = -1
+        i = 0
+        end = len(data)
+        while i < end:
+            if state == TEXT:
+                j = data.find(IAC, i)
+                if j == -1:
+                    text.append(data[i:])
+                    break
+                if j > i:
+                    text.append(data[i:j])
+                state = COMMAND
+                i = j + 1
+            elif state == COMMAND:
+                cmd = data[i]
+                i += 1
+                if cmd == IAC_I:  # escaped IAC, it's just text
+                    text.append(IAC)
+                    state = TEXT
+                elif cmd == SB_I:
+                    state = SB_OPTION
+                elif cmd in NEGOTIATIONS_I:
+                    self.cmd = BYTES[cmd]
+                    state = OPTION
+                else:  # two byte command, e.g. IAC NOP
+                    if text:
+                        yield TextEvent(b''.join(text))
+                        text = []
+                    state = TEXT
+                    yield CommandEvent(BYTES[cmd], None, b'')
+            elif state == OPTION:
+                if text:
+                    yield TextEvent(b''.join(text))
+                    text = []
+                option = BYTES[data[i]]
+                i += 1
+                state = TEXT
+                yield CommandEvent(self.cmd, option, b'')
+            elif state == SB_OPTION:
+                byte = data[i]
+                self.option = BYTES[byte]
+                i += 1
+                state = SB_DATA
+                sb_start = i
+                limit = self.sb_limit = self.sb_limits[byte]
+                if limit == SB_STREAMING:
+                    if text:
+                        yield TextEvent(b''.join(text))
+                        text = []
+                    yield SBStartEvent(self.option)
+            elif state == SB_DATA:
+                j = data.find(IAC, i)
+                if j == -1:
+                    break  # it all goes in sb_buf below
+                if j > i and sb_start == -1:
+                    self.sb_buf += data[i:j]
+                state = SB_IAC
+                i = j + 1
+            elif state == SB_IAC:
+                byte = data[i]
+                i += 1
+                if byte == SE_I:
+                    if text:
+                        yield TextEvent(b''.join(text))
+                        text = []
+                    if sb_start != -1:
+                        sb_data = data[sb_start:i-2]
+                        sb_start = -1
+                    else:
+                        sb_data = bytes(self.sb_buf)
+                        self.sb_buf = bytearray()
+                    state = TEXT
+                    if len(sb_data) > self.sb_limit:
+                        for event in self._end_subneg(sb_data):
+                            yield event
+                        continue
+                    yield CommandEvent(SB, self.option, sb_data)
+                    if self.decompressor is not None and not compressed:
+                        # compression starts right after IAC SB MCCP2 IAC SE
+                        self.rest = data[i:]
+                        break
+                elif sb_start != -1:
+                    # not one slice after all
+                    self.sb_buf += data[sb_start:i-2]
+                    sb_start = -1
+                    i -= 1  # and again
+                elif byte == IAC_I:  # escaped IAC in the payload
+                    self.sb_buf += IAC
+                    state = SB_ESCAPED
+                else:
+                    # not legal, but keep it the way the IAC+SE finders do
+                    self.sb_buf += IAC + BYTES[byte]
+                    state = SB_ESCAPED
+            else:  # SB_ESCAPED
+                # this payload has escaped IACs, which could be all of it. so rather
+                # than going around the loop for each one let the finder skip them
+                j = self.finder(data, i, end)
+                if j == -1:
+                    # keep it all, except an unpaired IAC at the end that may be the start of IAC SE
+                    part = data[i:]
+                    if (len(part) - len(part.rstrip(IAC))) % 2:
+                        part = part[:-1]
+                        state = SB_IAC
+                    self.sb_buf += unescape(part)
+                    break
+                if j > i:
+                    self.sb_buf += unescape(data[i:j])
+                state = SB_IAC
+                i = j + 1
+        if state >= SB_DATA:
+            # the end of the chunk in the middle of an SB
+            if sb_start != -1:
+                self.sb_buf += data[sb_start:end - (state == SB_IAC)]
+            elif state == SB_DATA:
+                self.sb_buf += data[i:]
+            if text:
+                yield TextEvent(b''.join(text))
+                text = []
+            buf = self.sb_buf
+            limit = self.sb_limit
+            if limit == SB_STREAMING:
+                if buf:
+                    self.sb_buf = bytearray()
+                    yield SBChunkEvent(self.option, bytes(buf))
+            elif limit == SB_DROPPING:
+                self.sb_buf = bytearray()
+            elif len(buf) > limit:
+                self.sb_buf = bytearray()
+                yield SBOverflowEvent(self.option, bytes(buf[:SB_HEAD]))
+                if self.sb_overflows and self.sb_overflows.get(self.option) == SB_ABORT:
+                    state = TEXT
+                else:
+                    self.sb_limit = SB_DROPPING
+        self.state = state
+        if text:
+            yield TextEvent(b''.join(text))
+
+    def _end_subneg(self, sb_data):
+        ''' the IAC SE of a payload we aren't just buffering '''
+        limit = self.sb_limit
+        if limit == SB_STREAMING:
+            if sb_data:
+                yield SBChunkEvent(self.option, sb_data)
+            yield SBEndEvent(self.option)
+        elif limit != SB_DROPPING:
+            # too big, but it all came in one chunk
+            yield SBOverflowEvent(self.option, sb_data[:SB_HEAD])
+
+    @property
+    def unparsed_size(self):
+        ''' about len(unparsed_data) without making it, SB payloads are counted unescaped '''
+        state = self.state
+        if state < SB_DATA:
+            return (0, 1, 2, 2)[state]
+        return 3 + len(self.sb_buf) + (state == SB_IAC)
+
+    @property
+    def unparsed_data(self):
+        ''' the partial control sequence we are holding on to, as it appeared on the wire '''
+        state = self.state
+        if state == TEXT:
+            return b''
+        if state == COMMAND:
+            return IAC
+        if state == OPTION:
+            return IAC + self.cmd
+        if state == SB_OPTION:
+            return IAC + SB
+        payload = IAC + SB + self.option + IAC_escape(bytes(self.sb_buf))
+        if state == SB_IAC:
+            payload += IAC
+        return payload
 
 
 matching_willdo_pairs = [
@@ -122,70 +607,562 @@ def dont_wont(tstate, cmd, option, sb_data):
         return b''  # no option, so we don't know what to refuse to do
     if cmd in [WILL, WONT]:
         tstate.options[option] = DONT
-        return IAC + DONT + option
+        return REPLIES[DONT][option]
     if cmd in [DO, DONT]:
         tstate.options[option] = WONT
-        return IAC + WONT + option
+        return REPLIES[WONT][option]
 
-    
-class TelnetState(object):
-    ''' State of negotiated options for the session and registry for nego handlers '''
+
+# how many commands TelnetState remembers by default
+HISTORY_SIZE = 64
+BAD_COMMANDS_SIZE = 16
+# what an idle client session (TelnetStream + TelnetState) costs, test_telneter keeps us honest.
+# about 1.3k of it is the option table and the history, and once we negotiate another 300
+# bytes is the Q method table (a byte per option), so 100k sessions is ~170MB.
+SESSION_BYTES = 1664
+
+# History flag bits
+NO_OPTION = 1  # a two byte command, option is None
+REPLY = 2  # we replied IAC <reply cmd> <option>
+EXTRA = 4  # there is an SB payload or a different reply in History.extras
+
+
+class History(object):
+    ''' Fixed size ring buffer of the commands we got and what we replied to them.
+
+        Each entry is packed into four bytes of a bytearray: cmd, option, reply cmd, flags.
+        SB payloads and replies that aren't a plain IAC <cmd> <option> are kept on the
+        side, truncated to max_extra bytes. A size of zero records nothing.
+    '''
+    __slots__ = ('size', 'max_extra', 'packed', 'extras', 'count')
+
+    def __init__(self, size=HISTORY_SIZE, max_extra=64):
+        self.size = size
+        self.max_extra = max_extra
+        self.packed = bytearray(4 * size)
+        self.extras = None  # slot: (sb_data, response), made when first needed
+        self.count = 0  # everything ever recorded, including what fell off the end
+
+    def __len__(self):
+        return min(self.count, self.size)
+
+    def __iter__(self):
+        ''' yield (cmd, option, sb_data, response) tuples, oldest first '''
+        for n in range(self.count - len(self), self.count):
+            yield self._unpack(n % self.size)
+
+    def recent(self, n=None):
+        ''' return a list of the last n entries, oldest first '''
+        entries = list(self)
+        if n is not None:
+            entries = entries[-n:] if n else []
+        return entries
+
+    def record(self, cmd, option, sb_data, response):
+        size = self.size
+        if not size:
+            return
+        slot = self.count % size
+        self.count += 1
+        extras = self.extras
+        if extras:
+            extras.pop(slot, None)
+        i = slot * 4
+        packed = self.packed
+        flags = 0
+        packed[i] = ord(cmd)
+        if option is None:
+            flags |= NO_OPTION
+            packed[i+1] = 0
+        else:
+            packed[i+1] = ord(option)
+        if not response:
+            response = b''
+        if len(response) == 3 and response[:1] == IAC and response[2:] == option:
+            flags |= REPLY
+            packed[i+2] = response[1]
+            response = b''
+        else:
+            packed[i+2] = 0
+        if sb_data or response:
+            flags |= EXTRA
+            if extras is None:
+                extras = self.extras = {}
+            extras[slot] = (sb_data[:self.max_extra], response[:self.max_extra])
+        packed[i+3] = flags
+
+    def clear(self):
+        self.packed = bytearray(4 * self.size)
+        self.extras = None
+        self.count = 0
+
+    def _unpack(self, slot):
+        i = slot * 4
+        cmd, option, reply, flags = self.packed[i:i+4]
+        cmd = BYTES[cmd]
+        option = None if flags & NO_OPTION else BYTES[option]
+        sb_data, response = self.extras[slot] if flags & EXTRA else (b'', b'')
+        if flags & REPLY:
+            response = IAC + BYTES[reply] + option
+        return cmd, option, sb_data, response
+
+    def __repr__(self):
+        return '<%s %d/%d>' % (self.__class__.__name__, len(self), self.size)
+
+
+class OptionTable(object):
+    ''' dict-like table of the state of every option, e.g. options[ECHO] = DO
+        Stored as a 256 byte bytearray indexed by the option byte, zero means unset.
+    '''
+    __slots__ = ('table',)
 
     def __init__(self):
-        self.handlers = {'default': dont_wont}
-        # state of current negotated options
-        self.options = {}
-        # record all cmd request tuples and byte responses
-        self.history = []
+        self.table = bytearray(256)
+
+    def __getitem__(self, option):
+        value = self.table[ord(option)]
+        if not value:
+            raise KeyError(option)
+        return BYTES[value]
+
+    def __setitem__(self, option, value):
+        self.table[ord(option)] = ord(value)
+
+    def __delitem__(self, option):
+        self[option]  # KeyError if it isn't set
+        self.table[ord(option)] = 0
+
+    def __contains__(self, option):
+        return option is not None and bool(self.table[ord(option)])
+
+    def __len__(self):
+        return len(self.table) - self.table.count(b'\0')
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def get(self, option, default=None):
+        if option is None:
+            return default
+        value = self.table[ord(option)]
+        if not value:
+            return default
+        return BYTES[value]
+
+    def keys(self):
+        return [option for option, value in self.items()]
+
+    def items(self):
+        return [(BYTES[option], BYTES[value]) for option, value in enumerate(self.table) if value]
+
+    def clear(self):
+        self.table = bytearray(256)
+
+    def __repr__(self):
+        return repr(dict(self.items()))
+
+
+class BadCommands(list):
+    ''' a list that only keeps the last BAD_COMMANDS_SIZE things appended to it '''
+    __slots__ = ()
+
+    def append(self, item):
+        if len(self) >= BAD_COMMANDS_SIZE:
+            del self[0]
+        list.append(self, item)
+
+
+class SharedHandlers(dict):
+    ''' a handler table that may be shared by many TelnetStates, so it can't be changed in place.
+        dispatch is made the first time it is needed: the list compiled by compile_handlers()
+        for a registered table, or an OverlayDispatch on base's list for a session's own table
+    '''
+    __slots__ = ('name', 'base', '_dispatch')
+
+    def __init__(self, handlers, name=None, base=None):
+        dict.__init__(self, handlers)
+        self.name = name
+        # the registered table this one was made from
+        self.base = base
+        self._dispatch = None
+
+    @property
+    def registered(self):
+        ''' the registered table we are, or were made from '''
+        if self.name is not None:
+            return self
+        return self.base or HANDLER_TABLES['default']
+
+    @property
+    def dispatch(self):
+        if self._dispatch is None:
+            if self.name is None:
+                self._dispatch = OverlayDispatch(self, self.registered)
+            else:
+                self._dispatch = compile_handlers(self)
+        return self._dispatch
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("%r handlers are shared, use TelnetState.set_handler() instead" % self.name)
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+
+# name: SharedHandlers
+HANDLER_TABLES = {}
+
+
+def register_handlers(name, handlers):
+    ''' register a table of handlers that TelnetStates can share by name '''
+    table = HANDLER_TABLES[name] = SharedHandlers(handlers, name)
+    return table
+
+
+# frozenset(handlers.items()): dispatch list, so registered tables with the same handlers share one
+_dispatch_cache = {}
+DISPATCH_CACHE_SIZE = 64
+# index into a dispatch list for commands that don't have an option
+NO_OPTION_I = 256
+
+
+def compile_handlers(handlers):
+    ''' Resolve the handler for every (cmd, option) pair ahead of time.
+        return a flat list, index it with ord(cmd) * 257 + ord(option) (or NO_OPTION_I)
+        The option handler wins, then the cmd handler, then 'default', same as always.
+    '''
+    key = frozenset(handlers.items())
+    dispatch = _dispatch_cache.get(key)
+    if dispatch is not None:
+        return dispatch
+
+    default = handlers.get('default')
+    by_option = [handlers.get(BYTES[option]) for option in range(256)]
+    dispatch = []
+    for cmd in range(256):
+        by_cmd = handlers.get(BYTES[cmd], default)
+        dispatch.extend([by_cmd if handler is None else handler for handler in by_option])
+        dispatch.append(by_cmd)
+
+    if len(_dispatch_cache) >= DISPATCH_CACHE_SIZE:
+        _dispatch_cache.clear()
+    _dispatch_cache[key] = dispatch
+    return dispatch
+
+
+class OverlayDispatch(object):
+    ''' A session's own handler table as a dispatch list, without compiling 65k entries of it.
+        Lookups for a cmd or option whose handler is different from the registered table's
+        are resolved as they happen, the rest come from the registered table's list.
+    '''
+    __slots__ = ('handlers', 'base', 'changed')
+
+    def __init__(self, handlers, base):
+        self.handlers = handlers
+        self.base = base.dispatch
+        changed = [key for key in set(handlers) | set(base) if handlers.get(key) is not base.get(key)]
+        # None if the default changed, then everything is resolved
+        self.changed = None if 'default' in changed else frozenset(map(ord, changed))
+
+    def __getitem__(self, i):
+        cmd, option = divmod(i, 257)
+        changed = self.changed
+        if changed is not None and option not in changed and cmd not in changed:
+            return self.base[i]
+        handlers = self.handlers
+        handler = None if option == NO_OPTION_I else handlers.get(BYTES[option])
+        if handler is None:
+            handler = handlers.get(BYTES[cmd], handlers.get('default'))
+        return handler
+
+
+# RFC 1143 "Q method": for every option we keep the state of each side, him (what the other
+# end WILL do) and us (what we WILL do), and whether we asked for a change that hasn't been
+# answered yet. That is three bits a side, so a q byte is him | us << Q_US_SHIFT.
+Q_NO, Q_YES, Q_WANTNO, Q_WANTYES = range(4)
+Q_OPPOSITE = 4  # change our mind again once the pending request is answered
+Q_US_SHIFT = 3
+
+# what to do with a WILL/WONT/DO/DONT we got, the ones up to Q_SEND are answered
+Q_IGNORE = 0  # it's already that way
+Q_ASK = 1  # they want to turn it on, our handler says yes or no
+Q_AGREE = 2  # they turned it off, we have to agree (but the handler gets to know)
+Q_SEND = 3  # the answer to something we asked for, but we changed our mind in the meantime
+Q_ACK = 4  # the answer to something we asked for, never answer an answer
+Q_ERROR = 5  # an answer to a question we didn't ask, believe it and say nothing
+
+# (side state, it's a WILL or DO): (new side state, action, reply is the yes or the no)
+_q_receive = {
+    (Q_NO, True): (Q_NO, Q_ASK, None),
+    (Q_YES, True): (Q_YES, Q_IGNORE, None),
+    (Q_WANTNO, True): (Q_NO, Q_ERROR, None),
+    (Q_WANTNO | Q_OPPOSITE, True): (Q_YES, Q_ERROR, None),
+    (Q_WANTYES, True): (Q_YES, Q_ACK, None),
+    (Q_WANTYES | Q_OPPOSITE, True): (Q_WANTNO, Q_SEND, False),
+    (Q_NO, False): (Q_NO, Q_IGNORE, None),
+    (Q_YES, False): (Q_NO, Q_AGREE, None),
+    (Q_WANTNO, False): (Q_NO, Q_ACK, None),
+    (Q_WANTNO | Q_OPPOSITE, False): (Q_WANTYES, Q_SEND, True),
+    (Q_WANTYES, False): (Q_NO, Q_ACK, None),
+    (Q_WANTYES | Q_OPPOSITE, False): (Q_NO, Q_ACK, None),
+}
+
+# the replies that mean yes and no for the side a command we got is about
+Q_SIDE_REPLIES = {WILL: (DO, DONT), WONT: (DO, DONT), DO: (WILL, WONT), DONT: (WILL, WONT)}
+
+# Q_RECEIVE[(ord(cmd) - WILL_I) << 3 | side state] ==
+#     (new side state, action, reply cmd or None, the side's yes and no replies, and them as ints)
+WILL_I = ord(WILL)
+Q_RECEIVE = []
+for _cmd in NEGOTIATIONS:
+    _replies = Q_SIDE_REPLIES[_cmd]
+    for _state in range(8):
+        _new, _action, _yes = _q_receive.get((_state, _cmd in (WILL, DO)), (_state, Q_IGNORE, None))
+        Q_RECEIVE.append((_new, _action, None if _yes is None else _replies[not _yes]) +
+                         _replies + tuple(map(ord, _replies)))
+
+# (side state, we want it on): (new side state, send the request)
+Q_REQUEST = {
+    (Q_NO, True): (Q_WANTYES, True),
+    (Q_YES, True): (Q_YES, False),
+    (Q_WANTNO, True): (Q_WANTNO | Q_OPPOSITE, False),
+    (Q_WANTNO | Q_OPPOSITE, True): (Q_WANTNO | Q_OPPOSITE, False),
+    (Q_WANTYES, True): (Q_WANTYES, False),
+    (Q_WANTYES | Q_OPPOSITE, True): (Q_WANTYES, False),
+    (Q_NO, False): (Q_NO, False),
+    (Q_YES, False): (Q_WANTNO, True),
+    (Q_WANTNO, False): (Q_WANTNO, False),
+    (Q_WANTNO | Q_OPPOSITE, False): (Q_WANTNO, False),
+    (Q_WANTYES, False): (Q_WANTYES | Q_OPPOSITE, False),
+    (Q_WANTYES | Q_OPPOSITE, False): (Q_WANTYES | Q_OPPOSITE, False),
+}
+
+# a q table for sessions that set their option table by hand before they negotiated
+Q_FROM_OPTIONS = bytearray(256)
+Q_FROM_OPTIONS[ord(DO)] = Q_YES
+Q_FROM_OPTIONS[ord(WILL)] = Q_YES << Q_US_SHIFT
+Q_FROM_OPTIONS = bytes(Q_FROM_OPTIONS)
+
+# answer at most this many negotiations every NEGOTIATION_WINDOW seconds, after that the
+# other end is looping or flooding us and we ignore it until the window is over
+NEGOTIATION_BUDGET = 100
+NEGOTIATION_WINDOW = 1.0
+
+
+register_handlers('default', {'default': dont_wont})
+
+
+class TelnetState(object):
+    ''' State of negotiated options for the session and registry for nego handlers
+
+        Sessions share their handler table with every other session that uses the same
+        registered table, set_handler() swaps in a new table for this session only.
+        Registered handler tables are compiled into a dispatch list so finding the handler
+        for a command is a single index, a session's own table only resolves what it changed.
+
+        WILL/WONT/DO/DONT go through the RFC 1143 Q method (see q), so handlers only hear
+        about requests, never about the answers to ours, and we never answer an answer.
+        Use request() to ask for something. A peer that makes us answer more than
+        NEGOTIATION_BUDGET negotiations in NEGOTIATION_WINDOW seconds is ignored for the rest of it.
+    '''
+    __slots__ = ('_handlers', 'dispatch', 'options', 'history', 'can_negotiate', 'bad_commands', 'decoders',
+                 'q', 'negotiations', 'window_start')
+
+    def __init__(self, history_size=HISTORY_SIZE, handlers='default'):
+        self.handlers = HANDLER_TABLES[handlers]
+        # the last thing we said about each option. both sides of an option share a byte,
+        # so use enabled() or q_state() to know whether a side is on
+        self.options = OptionTable()
+        # record recent cmd request tuples and byte responses
+        self.history = History(history_size)
         # remember if we have ever seen the other end do *real* negotiation
         self.can_negotiate = False
-        # record slightly invalid command tuples
-        self.bad_commands = []
-    
+        # record recent slightly invalid command tuples
+        self.bad_commands = BadCommands()
+        # None, or {option: SubnegDecoder} once somebody subscribe()s
+        self.decoders = None
+        # None until we negotiate, then a bytearray of Q method states indexed by option
+        self.q = None
+        # how many negotiations we answered since window_start
+        self.negotiations = 0
+        self.window_start = 0.0
+
     @classmethod
     def make_smartstate(cls):
         ''' return a new TelnetState object with some enhanced sensible handlers '''
-        tstate = cls()
-        tstate.handlers[AYT] = AYT_handler
-        tstate.handlers[ECHO] = ECHO_handler
-        return tstate
+        return cls(handlers='smart')
+
+    @property
+    def handlers(self):
+        return self._handlers
+
+    @handlers.setter
+    def handlers(self, handlers):
+        if not isinstance(handlers, SharedHandlers):
+            handlers = SharedHandlers(handlers, base=self._handlers.registered)
+        self._handlers = handlers
+        self.dispatch = handlers.dispatch
+
+    @property
+    def handlers_name(self):
+        ''' the registered name of our handler table, or None if we customized it '''
+        return self._handlers.name
+
+    def set_handler(self, key, handler):
+        ''' use handler for key (an option, a cmd, or 'default') in this session only '''
+        handlers = dict(self._handlers)
+        handlers[key] = handler
+        self.handlers = handlers
+
+    def subscribe(self, option, name, callback):
+        ''' call callback(tstate, name, value) for each GMCP message or MSDP variable called name.
+            A GMCP name can also be a package, 'Char' gets 'Char.Vitals' and 'Char.Status'.
+            Only needs the 'smart' handlers, which agree to GMCP/MSDP once somebody subscribed.
+        '''
+        if option not in DECODERS:
+            raise ValueError("Don't know how to decode option %r" % option)
+        if self.decoders is None:
+            self.decoders = {}
+        decoder = self.decoders.get(option)
+        if decoder is None:
+            decoder = self.decoders[option] = DECODERS[option]()
+        decoder.subscribe(name, callback)
+
+    def unsubscribe(self, option, name, callback):
+        self.decoders[option].unsubscribe(name, callback)
 
     @property
     def local_echo(self):
         ''' return True if we are echoing, False otherwise '''
-        # if we told the server DO ECHO then we shouldn't echo locally
-        return self.options.get(ECHO) != DO
+        # if the server agreed to echo then we shouldn't echo locally
+        return not self.enabled(DO, ECHO)
 
     def recieve_command(self, cmd, option, sb_data):
         ''' check our handlers and construct a reply as well as updating our state '''
-        if option in self.handlers:
-            handler = self.handlers[option]
-        elif cmd in self.handlers:
-            handler = self.handlers[cmd]
-        elif 'default' in self.handlers:
-            handler = self.handlers['default']
+        cmd_i = ord(cmd)
+        if option is None:
+            handler = self.dispatch[cmd_i * 257 + NO_OPTION_I]
         else:
-            self.history.append(b'')
+            option_i = ord(option)
+            handler = self.dispatch[cmd_i * 257 + option_i]
+        history = self.history
+        if handler is None:
+            if history.size:
+                history.record(cmd, option, sb_data, b'')
             return b''
 
-        if option not in [None, ECHO]:
+        if not self.can_negotiate and option is not None and option != ECHO:
             self.can_negotiate = True  # not just a dumb server
 
-        # RFC 854 says we should ignore a request if we are already in the desired state
-        current = self.options.get(option)
-        for ask, result in matching_willdo_pairs:
-            if cmd == ask and current == result:
-                return b''
+        if option is not None and cmd_i in NEGOTIATIONS_I:
+            response = self._negotiate(handler, cmd, cmd_i, option, option_i, sb_data)
+            if response is None:
+                return b''  # nothing happened, so don't clutter the history
+        else:
+            response = handler(self, cmd, option, sb_data)
+        if history.size:
+            history.record(cmd, option, sb_data, response)
+        return response
 
-        response = handler(self, cmd, option, sb_data)
-        self.history.append(response)
+    def _negotiate(self, handler, cmd, cmd_i, option, option_i, sb_data):
+        ''' the Q method for a WILL/WONT/DO/DONT we got, return the reply or None to ignore it '''
+        q = self.q
+        if q is None:
+            q = self.q = self.options.table.translate(Q_FROM_OPTIONS)
+        shift = 0 if cmd_i <= WILL_I + 1 else Q_US_SHIFT  # WILL/WONT are about him
+        q_byte = q[option_i]
+        state, action, reply, yes, no, yes_i, no_i = Q_RECEIVE[(cmd_i - WILL_I) << 3 | (q_byte >> shift & 7)]
+        if action == Q_IGNORE:
+            # RFC 854 says we should ignore a request if we are already in the desired state
+            return None
+        if action <= Q_SEND:
+            negotiations = self.negotiations = self.negotiations + 1
+            if (negotiations == 1 or negotiations > NEGOTIATION_BUDGET) and self._over_budget():
+                if negotiations == NEGOTIATION_BUDGET + 1:
+                    self.bad_commands.append((cmd, option, sb_data))  # just the first one
+                return None
+        table = self.options.table
+        if action == Q_ASK:
+            response = handler(self, cmd, option, sb_data)
+            if table[option_i] == yes_i or response == REPLIES[yes][option]:
+                state = Q_YES
+                if not response:
+                    response = REPLIES[yes][option]
+            else:
+                state = Q_NO
+                if not response:
+                    response = REPLIES[no][option]  # say no, they are waiting to hear
+        elif action == Q_AGREE:
+            response = handler(self, cmd, option, sb_data) or REPLIES[no][option]
+        elif action == Q_SEND:
+            response = REPLIES[reply][option]
+        else:
+            if action == Q_ERROR:
+                self.bad_commands.append((cmd, option, sb_data))
+            response = b''
+        q[option_i] = q_byte & ~(7 << shift) | state << shift
+        table[option_i] = yes_i if state & 1 else no_i  # Q_YES and Q_WANTYES are odd
         return response
 
+    @property
+    def flooding(self):
+        ''' True if the other end went over its negotiation budget and is being ignored '''
+        return (self.negotiations > NEGOTIATION_BUDGET and
+                time.monotonic() - self.window_start < NEGOTIATION_WINDOW)
+
+    def _over_budget(self):
+        ''' the first negotiation in a window starts the clock, return True if we answered
+            too many before the window was over
+        '''
+        if self.negotiations == 1:
+            self.window_start = time.monotonic()
+        else:
+            now = time.monotonic()
+            if now - self.window_start < NEGOTIATION_WINDOW:
+                return True
+            self.negotiations, self.window_start = 1, now
+        return False
+
+    def request(self, cmd, option):
+        ''' ask for a change to option, WILL/WONT for our side of it and DO/DONT for theirs.
+            return the bytes to send, which are empty if it is already that way or we
+            already asked (then it happens once the other end answers).
+        '''
+        q = self.q
+        if q is None:
+            q = self.q = self.options.table.translate(Q_FROM_OPTIONS)
+        shift = Q_US_SHIFT if cmd in (WILL, WONT) else 0
+        option_i = ord(option)
+        q_byte = q[option_i]
+        state, send = Q_REQUEST[(q_byte >> shift & 7, cmd in (WILL, DO))]
+        q[option_i] = q_byte & ~(7 << shift) | state << shift
+        if not send:
+            return b''
+        self.options[option] = cmd
+        return REPLIES[cmd][option]
+
+    def enabled(self, side, option):
+        ''' True if option is on for one side of the connection, side is WILL for ours
+            and DO for the other end's
+        '''
+        us, him = self.q_state(option)
+        return (us if side == WILL else him) == Q_YES
+
+    def q_state(self, option):
+        ''' return (us, him), the Q method state (Q_NO, Q_YES, Q_WANTNO or Q_WANTYES) of each side of option '''
+        q_byte = self.q[ord(option)] if self.q is not None else Q_FROM_OPTIONS[self.options.table[ord(option)]]
+        return q_byte >> Q_US_SHIFT & 3, q_byte & 3
+
+    def recieve_commands(self, commands):
+        ''' recieve_command() for a burst of (cmd, option, sb_data), e.g. everything a client
+            asks for when it connects. Returns all the replies joined into one bytestring.
+        '''
+        recieve_command = self.recieve_command
+        return b''.join([recieve_command(cmd, option, sb_data) or b'' for cmd, option, sb_data in commands])
+
     def construct_status(self):
         ''' return a bytestring command sequence that says what we think the world looks like '''
-        payload = b''
-        for option, status in sorted(self.options.items()):
-            payload += status + option  # e.g. WILL+ECHO
+        # one pass over the option table, which is already in option order
+        payload = b''.join([BYTES[status] + BYTES[option]  # e.g. WILL+ECHO
+                            for option, status in enumerate(self.options.table) if status])
         return construct_control(SB, STATUS+IS, payload)
 
     def __repr__(self):
@@ -202,35 +1179,757 @@ class TelnetState(object):
                                                     
 
 
+# when Compressor flushes the compressed stream so the other end can see it
+FLUSH_WRITE = 'write'  # after every send()
+FLUSH_PROMPT = 'prompt'  # after sends that end in IAC GA or IAC EOR
+FLUSH_TIME = 'time'  # when flush_interval seconds have passed since the last flush
+
+# commands that end a prompt
+PROMPTS = frozenset([GA, EOR])
+
+# (cmd, option) received while side X of option is on (WILL ours, DO theirs, see TelnetState.enabled())
+# means compress what we send from here on
+COMPRESS_WHEN = {(DO, MCCP2): WILL}
+# (cmd, option) received while side X of option is off means stop compressing, e.g. the
+# client turned MCCP2 down after all
+STOP_COMPRESS_WHEN = {(DONT, MCCP2): WILL}
+# (SB, option) received while side X of option is on means decompress what we receive from here on
+DECOMPRESS_WHEN = {(SB, MCCP2): DO, (SB, MCCP3): WILL}
+
+
+class Compressor(object):
+    ''' zlib compression of outbound data once MCCP2 is agreed to, and how well it is doing '''
+    __slots__ = ('level', 'wbits', 'memlevel', 'flush_policy', 'flush_interval', 'clock', 'zobj',
+                 'last_flush', 'bytes_in', 'bytes_out')
+
+    def __init__(self, level=6, wbits=15, memlevel=8, flush=FLUSH_WRITE, flush_interval=0.05, clock=time.time):
+        if flush not in (FLUSH_WRITE, FLUSH_PROMPT, FLUSH_TIME):
+            raise ValueError("Unknown flush policy %r" % flush)
+        self.level = level
+        self.wbits = wbits
+        self.memlevel = memlevel
+        self.flush_policy = flush
+        self.flush_interval = flush_interval
+        self.clock = clock
+        self.zobj = None
+        self.last_flush = 0
+        # bytes before and after compression
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    @property
+    def active(self):
+        return self.zobj is not None
+
+    @property
+    def ratio(self):
+        ''' compressed size as a fraction of the original, lower is better '''
+        if not self.bytes_in:
+            return 1.0
+        return float(self.bytes_out) / self.bytes_in
+
+    def start(self):
+        self.zobj = zlib.compressobj(self.level, zlib.DEFLATED, self.wbits, self.memlevel)
+        self.last_flush = self.clock()
+
+    def compress(self, data, flush=False):
+        ''' return the compressed bytes that are ready to send, flushing as the policy says
+            or if flush is True
+        '''
+        out = self.zobj.compress(data)
+        policy = self.flush_policy
+        if (flush or policy == FLUSH_WRITE or
+            policy == FLUSH_PROMPT and data[-2:] in (IAC+GA, IAC+EOR) or
+            policy == FLUSH_TIME and self.clock() - self.last_flush >= self.flush_interval):
+            out += self.zobj.flush(zlib.Z_SYNC_FLUSH)
+            self.last_flush = self.clock()
+        self.bytes_in += len(data)
+        self.bytes_out += len(out)
+        return out
+
+    def flush(self):
+        ''' return everything zlib is holding on to '''
+        out = self.zobj.flush(zlib.Z_SYNC_FLUSH)
+        self.last_flush = self.clock()
+        self.bytes_out += len(out)
+        return out
+
+    def finish(self):
+        ''' end the compressed stream, return the last of it '''
+        out = self.zobj.flush(zlib.Z_FINISH)
+        self.zobj = None
+        self.bytes_out += len(out)
+        return out
+
+
+# the C0 control characters that mean nothing in NVT text. BEL, BS, HT, LF, VT, FF
+# and CR do (RFC 854), and ESC starts the ANSI colour codes everybody uses
+NVT_STRIP = bytes(c for c in range(32) if c not in b'\a\b\t\n\v\f\r\x1b')
+
+
+class LineAssembler(object):
+    ''' Turn telnet text into lines, a chunk at a time.
+
+        One translate() drops the characters in strip, including NUL so CR NUL
+        becomes a plain CR. Lines end at LF and lose the CRs at either end, which
+        covers CR LF, a bare LF and the LF CR that lots of MUDs send.
+        Whatever follows the last LF is kept without being looked at again until
+        the rest of its line arrives, it is usually a prompt, see partial.
+        With an encoding the text is decoded incrementally, so a character split
+        between two reads comes out whole.
+    '''
+    __slots__ = ('strip', 'decoder', 'parts', 'lines')
+
+    def __init__(self, encoding=None, errors='replace', strip=NVT_STRIP):
+        self.strip = strip
+        self.decoder = None
+        if encoding is not None:
+            self.decoder = codecs.getincrementaldecoder(encoding)(errors)
+        # the start of the line we are in the middle of
+        self.parts = []
+        # complete lines that haven't been read()
+        self.lines = []
+
+    def feed(self, data):
+        ''' add text, as it came out of the parser '''
+        text = data.translate(None, self.strip)
+        decoder = self.decoder
+        if decoder is None:
+            newline, cr = b'\n', b'\r'
+        else:
+            text = decoder.decode(text)
+            newline, cr = '\n', '\r'
+        if newline not in text:
+            if text:
+                self.parts.append(text)
+            return
+        lines = text.split(newline)
+        parts = self.parts
+        if parts:
+            parts.append(lines[0])
+            lines[0] = newline[:0].join(parts)
+        last = lines.pop()
+        self.parts = [last] if last else []
+        self.lines.extend([line.strip(cr) for line in lines])
+
+    def read(self):
+        ''' return the complete lines so far, and forget them '''
+        lines, self.lines = self.lines, []
+        return lines
+
+    def end_prompt(self):
+        ''' the other end says the partial line is a whole prompt (IAC GA or IAC EOR),
+            return it and start a new line
+        '''
+        prompt = self.partial
+        self.parts = []
+        return prompt
+
+    @property
+    def partial(self):
+        ''' the text after the last complete line, e.g. a prompt '''
+        parts = self.parts
+        if len(parts) > 1:
+            parts[:] = [parts[0][:0].join(parts)]
+        if parts:
+            return parts[0]
+        return '' if self.decoder is not None else b''
+
+
+# upper bounds of the SB size histogram buckets, the last bucket is everything bigger
+SB_SIZE_BUCKETS = (16, 64, 256, 1024, 4096, 16384, 65536)
+
+
+class Stats(object):
+    ''' Counters for one TelnetStream (see TelnetStream.instrument()) or the sum of many.
+
+        Commands are counted by (cmd, option) as they come out of the parser, SB payload
+        sizes are unescaped, and the times are cumulative seconds spent in the parser and
+        in our handlers (TelnetState.recieve_command() and friends).
+    '''
+    __slots__ = ('bytes_in', 'bytes_out', 'text_bytes', 'control_bytes', 'commands', 'sb_count',
+                 'sb_sizes', 'sb_bytes', 'peak_unparsed', 'parse_calls', 'events', 'parse_time',
+                 'handler_time', 'aggregator', '__weakref__')
+
+    def __init__(self, aggregator=None):
+        self.bytes_in = self.bytes_out = self.text_bytes = self.control_bytes = 0
+        # (cmd, option): count
+        self.commands = {}
+        self.sb_count = self.sb_bytes = 0
+        # counts for each SB_SIZE_BUCKETS bucket, plus one for the rest
+        self.sb_sizes = [0] * (len(SB_SIZE_BUCKETS) + 1)
+        self.peak_unparsed = 0
+        self.parse_calls = self.events = 0
+        self.parse_time = self.handler_time = 0.0
+        # the StatsAggregator we add ourselves to when we go away
+        self.aggregator = aggregator
+        if aggregator is not None:
+            aggregator.live.add(self)
+
+    def __del__(self):
+        if self.aggregator is not None:
+            self.aggregator.retired.merge(self)
+
+    def count_sb(self, size):
+        self.sb_count += 1
+        self.sb_bytes += size
+        for i, bound in enumerate(SB_SIZE_BUCKETS):
+            if size <= bound:
+                self.sb_sizes[i] += 1
+                return
+        self.sb_sizes[-1] += 1
+
+    def merge(self, other):
+        ''' add other's counts to ours '''
+        for name in ('bytes_in', 'bytes_out', 'text_bytes', 'control_bytes', 'sb_count', 'sb_bytes',
+                     'parse_calls', 'events', 'parse_time', 'handler_time'):
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        commands = self.commands
+        for key, count in other.commands.items():
+            commands[key] = commands.get(key, 0) + count
+        self.sb_sizes = [mine + theirs for mine, theirs in zip(self.sb_sizes, other.sb_sizes)]
+        self.peak_unparsed = max(self.peak_unparsed, other.peak_unparsed)
+
+    def snapshot(self):
+        ''' return {sample name: value} with prometheus style names and labels,
+            see prometheus_text() to turn it into the text format
+        '''
+        snap = {
+            'telneter_bytes_in_total': self.bytes_in,
+            'telneter_bytes_out_total': self.bytes_out,
+            'telneter_text_bytes_total': self.text_bytes,
+            'telneter_control_bytes_total': self.control_bytes,
+            'telneter_unparsed_bytes_peak': self.peak_unparsed,
+            'telneter_parse_calls_total': self.parse_calls,
+            'telneter_events_total': self.events,
+            'telneter_parse_seconds_total': self.parse_time,
+            'telneter_handler_seconds_total': self.handler_time,
+        }
+        for (cmd, option), count in sorted(self.commands.items(), key=lambda item: (item[0][0], item[0][1] or b'')):
+            snap['telneter_commands_total{cmd="%s",option="%s"}' % (
+                _label(cmd), '' if option is None else _label(option))] = count
+        total = 0
+        for bound, count in zip(SB_SIZE_BUCKETS + ('+Inf',), self.sb_sizes):
+            total += count
+            snap['telneter_sb_bytes_bucket{le="%s"}' % bound] = total
+        snap['telneter_sb_bytes_sum'] = self.sb_bytes
+        snap['telneter_sb_bytes_count'] = self.sb_count
+        return snap
+
+
+def _label(value):
+    ''' the name of a cmd or option for a label, its number if we don't know it '''
+    return val_to_name.get(value, str(ord(value)))
+
+
+class StatsAggregator(object):
+    ''' Process-wide totals for every instrumented TelnetStream, live or gone. '''
+
+    def __init__(self):
+        self.live = weakref.WeakSet()
+        # what the streams that went away added up to
+        self.retired = Stats()
+
+    def total(self):
+        total = Stats()
+        total.merge(self.retired)
+        for stats in list(self.live):
+            total.merge(stats)
+        return total
+
+    def snapshot(self):
+        ''' Stats.snapshot() of everything, plus how many streams are instrumented right now '''
+        snap = self.total().snapshot()
+        snap['telneter_streams'] = len(self.live)
+        return snap
+
+
+def prometheus_text(snapshot):
+    ''' format a snapshot() as prometheus text exposition lines '''
+    return ''.join('%s %s\n' % (name, value) for name, value in snapshot.items())
+
+
+# the aggregator TelnetStream.instrument() uses unless it is told otherwise
+STATS = StatsAggregator()
+
+
+# TelnetStream.snapshot() format. Bump the version when it changes, restore() refuses
+# versions it doesn't know
+SNAPSHOT_MAGIC = b'TS'
+SNAPSHOT_VERSION = 2
+# magic, version, flags, parser state, parser cmd, SB option, sb_limit, max_inflate, history size
+SNAPSHOT_HEAD = struct.Struct('<2sBBBBBiII')
+# then the handler table name (a byte of length), the option table and the q table
+# (a short count of nonzero entries, then option and value bytes), sb_limits that
+# aren't the default (a short count of option byte and limit), the SB_ABORT options
+# (a short count of option bytes), the compressor settings, and last the SB payload
+# so far and what is waiting to be sent (each an int length and the bytes)
+SNAPSHOT_LIMIT = struct.Struct('<Bi')
+SNAPSHOT_COMPRESSOR = struct.Struct('<bbBBd')  # level, wbits, memlevel, flush policy, flush_interval
+SNAPSHOT_COUNT = struct.Struct('<H')
+SNAPSHOT_LENGTH = struct.Struct('<I')
+# flags
+SNAP_NEGOTIATE = 1  # can_negotiate
+SNAP_Q = 2  # there is a q table
+SNAP_COMPRESSOR = 4
+SNAP_CMD = 8  # parser.cmd is set
+SNAP_OPTION = 16  # parser.option is set
+SNAP_SB_LIMITS = 32  # the parser has its own sb_limits
+FLUSH_POLICIES = (FLUSH_WRITE, FLUSH_PROMPT, FLUSH_TIME)
+
+
+def _snapshot_pairs(table):
+    ''' the nonzero bytes of a 256 byte table as a count and option, value pairs '''
+    pairs = bytearray()
+    for option, value in enumerate(table):
+        if value:
+            pairs.append(option)
+            pairs.append(value)
+    return SNAPSHOT_COUNT.pack(len(pairs) // 2) + pairs
+
+
+def _restore_pairs(data, i):
+    ''' return the 256 byte table _snapshot_pairs() wrote at data[i:], and where it ended '''
+    count, = SNAPSHOT_COUNT.unpack_from(data, i)
+    i += SNAPSHOT_COUNT.size
+    table = bytearray(256)
+    pairs = data[i:i + count * 2]
+    table_set = table.__setitem__
+    for j in range(0, len(pairs), 2):
+        table_set(pairs[j], pairs[j+1])
+    return table, i + count * 2
+
+
 class TelnetStream(object):
-    ''' I/O interface for a Telnet Stream '''
-    def __init__(self, state=None):
+    ''' I/O interface for a Telnet Stream
+
+        Everything we have to send goes into one bytearray, use data_to_send() to see it
+        and consume(n) once n bytes of it have been written, or take_data() to have all of
+        it without a copy.
+
+        An idle client session (TelnetStream + TelnetState with the default history size)
+        costs at most SESSION_BYTES bytes, handler tables are shared between sessions.
+
+        Big SB payloads (file or map transfers) can go to a handler in pieces as they
+        arrive, see stream_subneg(). Payloads that grow past their limit are dropped and
+        recorded in state.bad_commands, see limit_subneg().
+
+        Text isn't kept unless you ask for it with assemble_lines(), then read_lines().
+        When it is, an IAC GA or IAC EOR is followed by a PromptEvent with the text
+        of the prompt, so there is no need to guess whether a partial line is a prompt.
+
+        Nothing is counted unless you ask for it with instrument(), then it is all in stats.
+
+        snapshot() packs a session into a few dozen bytes and restore() brings it back,
+        e.g. in another process, without negotiating again.
+    '''
+    __slots__ = ('state', 'parser', 'outbuf', 'compressor', 'sb_handlers', 'text', 'stats')
+    def __init__(self, state=None, compressor=None):
         if state is None:
             state = TelnetState.make_smartstate()
         self.state = state
-        self.unparsed_data = b''
-        self.pending_outputs = []
+        self.parser = TelnetParser()
+        self.outbuf = bytearray()
+        # only set if we are willing to compress what we send
+        self.compressor = compressor
+        # {option: handler} for streamed SB payloads
+        self.sb_handlers = None
+        # a LineAssembler, if we are keeping the text
+        self.text = None
+        # Stats, if we are counting
+        self.stats = None
+
+    @classmethod
+    def make_server(cls, state=None, **compress_args):
+        ''' return a new TelnetStream for the server end that offers to compress its output
+            (MCCP2) and to decompress the client's (MCCP3). compress_args are passed to Compressor.
+        '''
+        stream = cls(state, Compressor(**compress_args))
+        stream.offer(MCCP2, MCCP3)
+        return stream
+
+    @property
+    def unparsed_data(self):
+        return self.parser.unparsed_data
+
+    def snapshot(self):
+        ''' Return the session as bytes for restore(): the negotiated options, where the parser
+            is (including a partial SB payload), SB limits, the compressor settings and
+            whatever hasn't been sent yet.
+            Not kept: the history (it keeps its size but starts empty), bad_commands and the
+            negotiation budget start over, and subscribe(), stream_subneg() handlers,
+            assemble_lines() and instrument() have to be done again.
+            Raises ValueError for handlers that aren't a registered table (see
+            register_handlers()) and for a zlib stream in either direction, there is no
+            saving zlib's state.
+        '''
+        state, parser, compressor = self.state, self.parser, self.compressor
+        name = state.handlers_name
+        if name is None:
+            raise ValueError("Can't snapshot handlers that aren't registered, see register_handlers()")
+        if parser.decompressor is not None or compressor is not None and compressor.active:
+            raise ValueError("Can't snapshot a session while it is compressing or decompressing")
+        flags = SNAP_NEGOTIATE if state.can_negotiate else 0
+        if state.q is not None:
+            flags |= SNAP_Q
+        if compressor is not None:
+            flags |= SNAP_COMPRESSOR
+        if parser.cmd is not None:
+            flags |= SNAP_CMD
+        if parser.option is not None:
+            flags |= SNAP_OPTION
+        if parser.sb_limits is not SB_LIMITS:
+            flags |= SNAP_SB_LIMITS
+        name = name.encode('utf-8')
+        parts = [
+            SNAPSHOT_HEAD.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, flags, parser.state,
+                               ord(parser.cmd or b'\0'), ord(parser.option or b'\0'),
+                               parser.sb_limit, parser.max_inflate, state.history.size),
+            BYTES[len(name)], name,
+            _snapshot_pairs(state.options.table),
+        ]
+        if state.q is not None:
+            parts.append(_snapshot_pairs(state.q))
+        if flags & SNAP_SB_LIMITS:
+            limits = [(option, limit) for option, limit in enumerate(parser.sb_limits) if limit != SB_LIMITS[option]]
+            parts.append(SNAPSHOT_COUNT.pack(len(limits)))
+            parts.extend([SNAPSHOT_LIMIT.pack(option, limit) for option, limit in limits])
+        aborts = b''.join([option for option, overflow in (parser.sb_overflows or {}).items()
+                           if overflow == SB_ABORT])
+        parts.append(SNAPSHOT_COUNT.pack(len(aborts)))
+        parts.append(aborts)
+        if compressor is not None:
+            parts.append(SNAPSHOT_COMPRESSOR.pack(compressor.level, compressor.wbits, compressor.memlevel,
+                                                  FLUSH_POLICIES.index(compressor.flush_policy),
+                                                  compressor.flush_interval))
+        sb_data = parser.sb_buf
+        parts.append(SNAPSHOT_LENGTH.pack(len(sb_data)))
+        parts.append(sb_data)
+        parts.append(SNAPSHOT_LENGTH.pack(len(self.outbuf)))
+        parts.append(self.outbuf)
+        return b''.join(parts)
+
+    @classmethod
+    def restore(cls, data):
+        ''' return a new stream picking up where the one snapshot() made data from left off '''
+        try:
+            magic, version, flags, parser_state, cmd, option, sb_limit, max_inflate, history_size = \
+                SNAPSHOT_HEAD.unpack_from(data)
+        except struct.error:
+            raise ValueError('Not a TelnetStream snapshot, too short')
+        if magic != SNAPSHOT_MAGIC:
+            raise ValueError('Not a TelnetStream snapshot, bad magic %r' % magic)
+        if version != SNAPSHOT_VERSION:
+            raise ValueError("Don't know TelnetStream snapshot version %d" % version)
+        try:
+            i = SNAPSHOT_HEAD.size
+            name = data[i+1:i+1+data[i]].decode('utf-8')
+            i += 1 + data[i]
+            if name not in HANDLER_TABLES:
+                raise ValueError('Snapshot uses handlers %r, which are not registered here' % name)
+            state = TelnetState(history_size=history_size, handlers=name)
+            state.can_negotiate = bool(flags & SNAP_NEGOTIATE)
+            state.options.table, i = _restore_pairs(data, i)
+            if flags & SNAP_Q:
+                state.q, i = _restore_pairs(data, i)
+
+            stream = cls(state)
+            parser = stream.parser
+            parser.state = parser_state
+            parser.cmd = BYTES[cmd] if flags & SNAP_CMD else None
+            parser.option = BYTES[option] if flags & SNAP_OPTION else None
+            parser.sb_limit, parser.max_inflate = sb_limit, max_inflate
+            if flags & SNAP_SB_LIMITS:
+                count, = SNAPSHOT_COUNT.unpack_from(data, i)
+                i += SNAPSHOT_COUNT.size
+                limits = parser.sb_limits = list(SB_LIMITS)
+                for n in range(count):
+                    option, limit = SNAPSHOT_LIMIT.unpack_from(data, i)
+                    i += SNAPSHOT_LIMIT.size
+                    limits[option] = limit
+            count, = SNAPSHOT_COUNT.unpack_from(data, i)
+            i += SNAPSHOT_COUNT.size
+            if count:
+                parser.sb_overflows = dict.fromkeys([BYTES[option] for option in data[i:i+count]], SB_ABORT)
+                i += count
+
+            if flags & SNAP_COMPRESSOR:
+                level, wbits, memlevel, policy, interval = SNAPSHOT_COMPRESSOR.unpack_from(data, i)
+                i += SNAPSHOT_COMPRESSOR.size
+                stream.compressor = Compressor(level, wbits, memlevel, FLUSH_POLICIES[policy], interval)
+
+            length, = SNAPSHOT_LENGTH.unpack_from(data, i)
+            i += SNAPSHOT_LENGTH.size
+            parser.sb_buf += data[i:i+length]
+            i += length
+            length, = SNAPSHOT_LENGTH.unpack_from(data, i)
+            i += SNAPSHOT_LENGTH.size
+            outbuf = data[i:i+length]
+            if len(outbuf) != length:
+                raise ValueError('TelnetStream snapshot is cut short')
+        except (struct.error, IndexError):
+            raise ValueError('TelnetStream snapshot is cut short')
+
+        stream.outbuf += outbuf
+        return stream
+
+    def offer(self, *options):
+        ''' tell the other end we WILL do each option, in one send() '''
+        request = self.state.request
+        self.send(b''.join([request(WILL, option) for option in options]), flush=True)
+
+    def data_to_send(self):
+        ''' return everything waiting to be sent '''
+        return bytes(self.outbuf)
+
+    def take_data(self):
+        ''' return everything waiting to be sent and forget it, like data_to_send() and then
+            consume() but without copying it. The bytearray is ours no more, so it is safe
+            to hand to something that holds on to it, e.g. an asyncio transport
+        '''
+        data = self.outbuf
+        self.outbuf = bytearray()
+        if self.stats is not None:
+            self.stats.bytes_out += len(data)
+        return data
+
+    def consume(self, n):
+        ''' forget the first n bytes of data_to_send(), e.g. after a partial socket.send() '''
+        del self.outbuf[:n]
+        if self.stats is not None:
+            self.stats.bytes_out += n
+
+    def send(self, data, flush=False):
+        ''' queue already escaped data, compressing it if we agreed to. flush=True gets it
+            out of zlib now whatever the flush policy, e.g. for negotiation replies
+        '''
+        compressor = self.compressor
+        if compressor is not None and compressor.active:
+            data = compressor.compress(data, flush)
+        self.outbuf += data
+
+    def send_text(self, text):
+        ''' queue text, escaping any IACs in it '''
+        compressor = self.compressor
+        if compressor is not None and compressor.active:
+            self.outbuf += compressor.compress(IAC_escape(text))
+        else:
+            _escape_into(self.outbuf, text)
+
+    def send_command(self, cmd, option=b''):
+        ''' queue IAC <cmd> <option> '''
+        self.send(construct_control(cmd, option))
+
+    def send_prompt(self, text):
+        ''' queue a prompt, ended with IAC EOR if the other end agreed to it or IAC GA if not '''
+        self.send_text(text)
+        if self.state.enabled(WILL, TELOPT_EOR):
+            self.send(IAC + EOR)
+        else:
+            self.send(IAC + GA)
+
+    def send_subneg(self, option, payload):
+        ''' queue IAC SB <option> <escaped payload> IAC SE '''
+        compressor = self.compressor
+        if compressor is not None and compressor.active:
+            self.send(construct_control(SB, option, payload))
+            return
+        outbuf = self.outbuf
+        outbuf += IAC + SB + option
+        _escape_into(outbuf, payload)
+        outbuf += IAC + SE
+
+    def flush(self):
+        ''' queue anything the compressor is holding on to '''
+        compressor = self.compressor
+        if compressor is not None and compressor.active:
+            self.outbuf += compressor.flush()
+
+    def poll(self):
+        ''' call this from a timer when using FLUSH_TIME compression '''
+        compressor = self.compressor
+        if (compressor is not None and compressor.active and
+            compressor.clock() - compressor.last_flush >= compressor.flush_interval):
+            self.flush()
+
+    def assemble_lines(self, encoding=None, errors='replace', strip=NVT_STRIP):
+        ''' put all the text we receive through a LineAssembler, return it '''
+        self.text = LineAssembler(encoding, errors, strip)
+        return self.text
+
+    def read_lines(self):
+        ''' return the lines received since last time, see assemble_lines() '''
+        return self.text.read()
+
+    def limit_subneg(self, option, max_size, overflow=SB_DISCARD):
+        ''' buffer at most max_size bytes of option's SB payloads, see TelnetParser.limit_subneg() '''
+        self.parser.limit_subneg(option, max_size, overflow)
+
+    def stream_subneg(self, option, handler):
+        ''' send option's SB payloads to handler in pieces as they arrive instead of
+            buffering them. handler has the methods
+                on_sb_start(tstate, option)
+                on_sb_chunk(tstate, option, data)
+                on_sb_end(tstate, option)
+            which return bytes to send, like any other handler.
+        '''
+        if self.sb_handlers is None:
+            self.sb_handlers = {}
+        self.sb_handlers[option] = handler
+        self.parser.stream_subneg(option)
+
+    def instrument(self, aggregator=STATS):
+        ''' start counting what goes through this stream, return the Stats.
+            They are added to aggregator's totals, unless it is None.
+            Bytes out are counted when they are consume()d.
+        '''
+        self.stats = Stats(aggregator)
+        return self.stats
+
+    def start_compression(self, option=MCCP2):
+        ''' send IAC SB <option> IAC SE and compress everything after it, if we aren't already '''
+        compressor = self.compressor
+        if compressor is None:
+            raise ValueError("Can't compress without a Compressor, see make_server()")
+        if compressor.active:
+            return
+        self.outbuf += IAC + SB + option + IAC + SE
+        compressor.start()
+
+    def stop_compression(self):
+        ''' end the compressed stream, everything after it is sent plain. Does nothing if we
+            aren't compressing
+        '''
+        compressor = self.compressor
+        if compressor is not None and compressor.active:
+            self.outbuf += compressor.finish()
 
     def receive_data(self, data):
-        ''' Consume data. May cause new pending outputs to be generated. '''
-        self.unparsed_data += data
-        control, text, unparsed = parse(self.unparsed_data)
-        self.unparsed_data = unparsed
-
-        # only one of these happens per parse()
-        if control:
-            response = self.recieve_command(*control)
-        elif text:
-            response = self.recieve_text(text)
-        if response:
-            self.pending_outputs.append(response)
-        return
+        ''' Consume data. May cause new data to send. '''
+        for event in self.events(data):
+            pass
+
+    def feed(self, data):
+        ''' Consume data and return a list of every event in it.
+            May cause new data to send.
+        '''
+        return list(self.events(data))
+
+    def events(self, data):
+        ''' Consume data, yielding each event after it has been handled. '''
+        stats = self.stats
+        parse = self.parser.parse(data)
+        if stats is not None:
+            parse = self._counted(parse, data, stats)
+            clock = time.perf_counter
+        for event in parse:
+            if stats is not None:
+                handling = clock()
+            cls = event.__class__
+            if cls is TextEvent:
+                response = self.recieve_text(event.text)
+            elif cls is CommandEvent:
+                response = self.recieve_command(*event)
+                key = event[:2]
+                if key in DECOMPRESS_WHEN or key in COMPRESS_WHEN or key in STOP_COMPRESS_WHEN:
+                    self._check_compression(key)
+            else:
+                response = self.recieve_subneg(event)
+            if response:
+                self.send(response, flush=True)  # the other end is waiting for it
+            if stats is not None:
+                stats.handler_time += clock() - handling
+            yield event
+            if cls is CommandEvent and event.cmd in PROMPTS and self.text is not None:
+                yield PromptEvent(self.text.end_prompt())
+
+    def _counted(self, parse, data, stats):
+        ''' the events from parse, counted and with the time it took to parse them, for events() '''
+        clock = time.perf_counter
+        stats.bytes_in += len(data)
+        stats.parse_calls += 1
+        while True:
+            start = clock()
+            event = next(parse, None)
+            stats.parse_time += clock() - start
+            if event is None:
+                break
+            stats.events += 1
+            cls = event.__class__
+            if cls is TextEvent:
+                stats.text_bytes += len(event.text)
+            elif cls is CommandEvent:
+                cmd, option, sb_data = event
+                key = event[:2]
+                stats.commands[key] = stats.commands.get(key, 0) + 1
+                if cmd == SB:
+                    stats.count_sb(len(sb_data))
+                    stats.control_bytes += len(sb_data) + 5
+                else:
+                    stats.control_bytes += 2 if option is None else 3
+            elif cls is SBChunkEvent:
+                stats.control_bytes += len(event.data)
+            yield event
+        stats.peak_unparsed = max(stats.peak_unparsed, self.parser.unparsed_size)
+
+    def _check_compression(self, key):
+        ''' start (de)compressing if the negotiation for it just finished, or stop
+            compressing if it was just turned off
+        '''
+        enabled = self.state.enabled
+        if key in DECOMPRESS_WHEN:
+            if enabled(DECOMPRESS_WHEN[key], key[1]):
+                self.parser.start_decompression()
+        elif key in COMPRESS_WHEN:
+            if (enabled(COMPRESS_WHEN[key], key[1]) and
+                    self.compressor is not None and not self.compressor.active):
+                self.start_compression(key[1])
+        elif not enabled(STOP_COMPRESS_WHEN[key], key[1]):
+            self.stop_compression()
 
     def recieve_command(self, cmd, option, sb_data):
-        return self.tstate(recieve_command(cmd, option, sb_data))
+        return self.state.recieve_command(cmd, option, sb_data)
 
     def recieve_text(self, data):
-        pass
+        if self.text is not None:
+            self.text.feed(data)
+
+    def recieve_subneg(self, event):
+        ''' a piece of a streamed SB payload, one that was too big, or compressed data we
+            couldn't inflate
+        '''
+        cls = event.__class__
+        if cls is SBOverflowEvent:
+            self.state.bad_commands.append((SB, event.option, event.head))
+            return None
+        if cls is DecompressErrorEvent:
+            # the parser doesn't know which of MCCP2 or MCCP3 started it
+            self.state.bad_commands.append((SB, None, event.head))
+            return None
+        handler = self.sb_handlers and self.sb_handlers.get(event.option)
+        if handler is None:  # the parser was told to stream it, but not us
+            return None
+        if cls is SBChunkEvent:
+            return handler.on_sb_chunk(self.state, event.option, event.data)
+        if cls is SBStartEvent:
+            return handler.on_sb_start(self.state, event.option)
+        return handler.on_sb_end(self.state, event.option)
+
+
+def _escape_into(buf, data):
+    ''' buf += IAC_escape(data), without making the escaped copy first '''
+    i = data.find(IAC)
+    if i == -1:
+        buf += data
+        return
+    view = memoryview(data)
+    start = 0
+    while i != -1:
+        buf += view[start:i+1]
+        buf += IAC
+        start = i + 1
+        i = data.find(IAC, start)
+    buf += view[start:]
 
 
 def AYT_handler(tstate, cmd, option, sb_data):
@@ -238,17 +1937,289 @@ def AYT_handler(tstate, cmd, option, sb_data):
         provides the user with some visible (e.g., printable) evidence that the system is still up and running.
     '''
     if option or sb_data:
-        tstate.bad_commands((cmd, option, sb_data))
+        tstate.bad_commands.append((cmd, option, sb_data))
     return b'I Am Here'
 
 
 def ECHO_handler(tstate, cmd, option, sb_data):
     if sb_data:
-        tstate.bad_commands((cmd, option, sb_data))
+        tstate.bad_commands.append((cmd, option, sb_data))
     if cmd == WILL:
         # prefered, the server will echo our commands back to us
         tstate.options[ECHO] = DO
-        return IAC + DO + ECHO
+        return REPLIES[DO][ECHO]
     if cmd == WONT:
         tstate.options[ECHO] = DONT
-        return IAC + DONT + ECHO
+        return REPLIES[DONT][ECHO]
+
+
+def prompt_handler(tstate, cmd, option, sb_data):
+    ''' IAC GA and IAC EOR end a prompt, TelnetStream does the rest '''
+    if option is not None or sb_data:
+        tstate.bad_commands.append((cmd, option, sb_data))
+    return b''
+
+
+def EOR_handler(tstate, cmd, option, sb_data):
+    ''' End Of Record (RFC 885): the server marks the end of each prompt with IAC EOR.
+        We are happy to have it, but don't send it ourselves unless we offered.
+    '''
+    if cmd == WILL:
+        tstate.options[TELOPT_EOR] = DO
+        return REPLIES[DO][TELOPT_EOR]
+    if cmd == WONT:
+        tstate.options[TELOPT_EOR] = DONT
+        return REPLIES[DONT][TELOPT_EOR]
+    return dont_wont(tstate, cmd, option, sb_data)
+
+
+def MCCP2_handler(tstate, cmd, option, sb_data):
+    ''' Mud Client Compression Protocol v2:
+        the server compresses everything it sends after IAC SB MCCP2 IAC SE.
+        We just agree to it, TelnetStream does the decompressing.
+    '''
+    if cmd == WILL:
+        tstate.options[MCCP2] = DO
+        return REPLIES[DO][MCCP2]
+    if cmd == WONT:
+        tstate.options[MCCP2] = DONT
+        return REPLIES[DONT][MCCP2]
+    if cmd == SB:
+        if sb_data:
+            tstate.bad_commands.append((cmd, option, sb_data))
+        return b''
+    return dont_wont(tstate, cmd, option, sb_data)
+
+
+# how many names SubnegDecoder remembers the subscribers for, and how many payloads it remembers
+ROUTE_CACHE_SIZE = 256
+MEMO_SIZE = 64
+
+
+class SubnegDecoder(object):
+    ''' Turns the SB payloads of one option into python objects for whoever subscribed to them.
+
+        Names nobody subscribed to are skipped before decoding, and a payload we saw recently
+        is looked up by hash instead of being decoded again, so values are shared between
+        calls and shouldn't be changed by the callbacks.
+    '''
+    __slots__ = ('subscriptions', 'routes', 'memo')
+    ignore_case = False
+
+    def __init__(self):
+        # name as subscribed (bytes): [callback, ..]
+        self.subscriptions = {}
+        # name as sent: (name as str, callbacks) or None if nobody wants it
+        self.routes = {}
+        # sb_data: decoded
+        self.memo = {}
+
+    def subscribe(self, name, callback):
+        if isinstance(name, str):
+            name = name.encode('ascii')
+        if self.ignore_case:
+            name = name.lower()
+        self.subscriptions.setdefault(name, []).append(callback)
+        self.routes.clear()
+        self.memo.clear()
+
+    def unsubscribe(self, name, callback):
+        if isinstance(name, str):
+            name = name.encode('ascii')
+        if self.ignore_case:
+            name = name.lower()
+        callbacks = self.subscriptions[name]
+        callbacks.remove(callback)
+        if not callbacks:
+            del self.subscriptions[name]
+        self.routes.clear()
+        self.memo.clear()
+
+    def route(self, name):
+        ''' return (name as str, callbacks) for a name as sent, or None if nobody subscribed '''
+        try:
+            return self.routes[name]
+        except KeyError:
+            pass
+        key = name.lower() if self.ignore_case else name
+        callbacks = list(self.subscriptions.get(key, ()))
+        while b'.' in key:
+            key = key.rpartition(b'.')[0]
+            callbacks.extend(self.subscriptions.get(key, ()))
+        route = (name.decode('latin-1'), callbacks) if callbacks else None
+        if len(self.routes) >= ROUTE_CACHE_SIZE:
+            self.routes.clear()
+        self.routes[name] = route
+        return route
+
+    def decode(self, sb_data):
+        ''' return a list of (route, value) for the parts of sb_data somebody subscribed to '''
+        raise NotImplementedError
+
+    def feed(self, tstate, sb_data):
+        memo = self.memo
+        decoded = memo.get(sb_data)
+        if decoded is None:
+            try:
+                decoded = self.decode(sb_data)
+            except ValueError:
+                tstate.bad_commands.append((SB, self.option, sb_data))
+                return
+            if len(memo) >= MEMO_SIZE:
+                memo.clear()
+            memo[sb_data] = decoded
+        for (name, callbacks), value in decoded:
+            for callback in callbacks:
+                callback(tstate, name, value)
+
+
+class GMCPDecoder(SubnegDecoder):
+    ''' GMCP payloads are "Package.Message <json>", the json is optional.
+        Package names are case insensitive.
+    '''
+    __slots__ = ()
+    option = GMCP
+    ignore_case = True
+
+    def feed(self, tstate, sb_data):
+        # skip anything nobody wants before it gets as far as a hash of the whole payload
+        i = sb_data.find(b' ')
+        if self.route(sb_data if i == -1 else sb_data[:i]) is not None:
+            SubnegDecoder.feed(self, tstate, sb_data)
+
+    def decode(self, sb_data):
+        name, _, payload = sb_data.partition(b' ')
+        value = json.loads(payload) if payload.strip() else None
+        return [(self.route(name), value)]
+
+
+# an MSDP payload is a run of these, everything else is a name or a value
+_msdp_token = re.compile(b'[\x01-\x06]|[^\x01-\x06]+')
+
+
+class MSDPDecoder(SubnegDecoder):
+    ''' MSDP payloads are VAR <name> VAL <value> [VAR <name> VAL <value> ..] where a value is
+        a string, a table (TABLE_OPEN VAR.. VAL.. TABLE_CLOSE) becomes a dict and an array
+        (ARRAY_OPEN VAL.. VAL.. ARRAY_CLOSE, or more than one VAL after a VAR) becomes a list.
+        Strings are decoded as utf-8.
+    '''
+    __slots__ = ()
+    option = MSDP
+
+    def decode(self, sb_data):
+        tokens = _msdp_token.findall(sb_data)
+        decoded = []
+        i, end = 0, len(tokens)
+        while i < end:
+            if tokens[i] != MSDP_VAR:
+                i += 1  # junk, skip to the next VAR
+                continue
+            i += 1
+            name = b''
+            if i < end and tokens[i] not in _MSDP_CONTROLS:
+                name = tokens[i]
+                i += 1
+            route = self.route(name)
+            if route is None:
+                i = self._skip(tokens, i)
+            else:
+                value, i = self._values(tokens, i)
+                decoded.append((route, value))
+        return decoded
+
+    @staticmethod
+    def _skip(tokens, i):
+        ''' return the index of the next VAR that isn't inside a table or an array '''
+        depth = 0
+        for i in range(i, len(tokens)):
+            token = tokens[i]
+            if token == MSDP_VAR and not depth:
+                return i
+            if token == MSDP_TABLE_OPEN or token == MSDP_ARRAY_OPEN:
+                depth += 1
+            elif token == MSDP_TABLE_CLOSE or token == MSDP_ARRAY_CLOSE:
+                depth -= 1
+        return len(tokens)
+
+    def _values(self, tokens, i):
+        ''' the VAL <value> [VAL <value> ..] after a name, one value or a list of them '''
+        values = []
+        while i < len(tokens) and tokens[i] == MSDP_VAL:
+            value, i = self._value(tokens, i + 1)
+            values.append(value)
+        if len(values) == 1:
+            return values[0], i
+        return (values or ''), i
+
+    def _value(self, tokens, i):
+        if i == len(tokens):
+            return '', i
+        token = tokens[i]
+        if token == MSDP_TABLE_OPEN:
+            table = {}
+            i += 1
+            while i < len(tokens) and tokens[i] == MSDP_VAR:
+                name = ''
+                if i + 1 < len(tokens) and tokens[i + 1] not in _MSDP_CONTROLS:
+                    name = tokens[i + 1].decode('utf-8', 'replace')
+                    i += 1
+                table[name], i = self._values(tokens, i + 1)
+            if i < len(tokens) and tokens[i] == MSDP_TABLE_CLOSE:
+                i += 1
+            return table, i
+        if token == MSDP_ARRAY_OPEN:
+            array = []
+            i += 1
+            while i < len(tokens) and tokens[i] == MSDP_VAL:
+                value, i = self._value(tokens, i + 1)
+                array.append(value)
+            if i < len(tokens) and tokens[i] == MSDP_ARRAY_CLOSE:
+                i += 1
+            return array, i
+        if token in _MSDP_CONTROLS:
+            return '', i  # an empty value
+        return token.decode('utf-8', 'replace'), i + 1
+
+
+_MSDP_CONTROLS = frozenset(BYTES[1:7])
+
+# option: SubnegDecoder class, what TelnetState.subscribe() can decode
+DECODERS = {
+    GMCP: GMCPDecoder,
+    MSDP: MSDPDecoder,
+}
+
+
+def decoding_handler(tstate, cmd, option, sb_data):
+    ''' GMCP and MSDP: agree to them if somebody subscribe()d and decode the SB payloads for them,
+        otherwise the same as dont_wont()
+    '''
+    decoders = tstate.decoders
+    decoder = decoders.get(option) if decoders else None
+    if decoder is None:
+        if cmd == SB:
+            return b''
+        return dont_wont(tstate, cmd, option, sb_data)
+    if cmd == SB:
+        decoder.feed(tstate, sb_data)
+        return b''
+    if cmd == WILL:
+        tstate.options[option] = DO
+        return REPLIES[DO][option]
+    if cmd == DO:
+        tstate.options[option] = WILL
+        return REPLIES[WILL][option]
+    return dont_wont(tstate, cmd, option, sb_data)
+
+
+register_handlers('smart', {
+    'default': dont_wont,
+    AYT: AYT_handler,
+    GA: prompt_handler,
+    EOR: prompt_handler,
+    ECHO: ECHO_handler,
+    TELOPT_EOR: EOR_handler,
+    MCCP2: MCCP2_handler,
+    GMCP: decoding_handler,
+    MSDP: decoding_handler,
+})
@@ -0,0 +1,205 @@
+'''
+asyncio glue for telneter.
+
+TelnetProtocol feeds whatever the transport reads through a TelnetStream and
+writes all the negotiation replies for a read with one write() call.
+The events come back out through read_event() or "async for event in protocol".
+
+    protocol = await open_connection('mud.example.com', 4000)
+    async for event in protocol:
+        if isinstance(event, telneter.TextEvent):
+            print(event.text)
+'''
+
+import asyncio
+import itertools
+from collections import deque
+
+import telneter
+
+# stop reading from the socket when this many events are waiting to be read. the events
+# of a read are only made as there is room for them, so one read of compressed data can't
+# inflate into more than this
+MAX_QUEUED_EVENTS = 1024
+
+
+class TelnetProtocol(asyncio.Protocol):
+    ''' asyncio Protocol around a TelnetStream, with a StreamReader/StreamWriter style interface '''
+
+    def __init__(self, stream=None, client_connected_cb=None, write_high=None, write_low=None,
+                 max_queued=MAX_QUEUED_EVENTS):
+        if stream is None:
+            stream = telneter.TelnetStream()
+        self.stream = stream
+        self.client_connected_cb = client_connected_cb
+        self.transport = None
+        self.write_high = write_high
+        self.write_low = write_low
+        self.max_queued = max_queued
+        self.events = deque()
+        # the events of reads we haven't queued all of yet, see _pull()
+        self._unread = None
+        self.exception = None
+        self.closed = False
+        self._reading_paused = False
+        self._writing_paused = False
+        self._read_waiter = None
+        self._drain_waiters = []
+        self._closed_waiter = None
+
+    # asyncio.Protocol callbacks
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.write_high is not None or self.write_low is not None:
+            transport.set_write_buffer_limits(self.write_high, self.write_low)
+        self._closed_waiter = asyncio.get_event_loop().create_future()
+        # the stream may already have something to say, e.g. a server offering MCCP2
+        self.flush()
+        if self.client_connected_cb is not None:
+            result = self.client_connected_cb(self)
+            if asyncio.iscoroutine(result):
+                asyncio.get_event_loop().create_task(result)
+
+    def data_received(self, data):
+        events = self.stream.events(data)
+        if self._unread is not None:  # the rest of an earlier read goes first
+            events = itertools.chain(self._unread, events)
+        self._unread = events
+        self._pull()
+        self._wake(self._read_waiter)
+        self._read_waiter = None
+
+    def eof_received(self):
+        self._close(None)
+
+    def connection_lost(self, exc):
+        self._close(exc)
+
+    def pause_writing(self):
+        self._writing_paused = True
+
+    def resume_writing(self):
+        self._writing_paused = False
+        waiters, self._drain_waiters = self._drain_waiters, []
+        for waiter in waiters:
+            self._wake(waiter)
+
+    # reading
+
+    async def read_event(self):
+        ''' return the next TextEvent or CommandEvent, or None at the end of the stream '''
+        while not self.events:
+            if self.closed:
+                if self.exception is not None:
+                    raise self.exception
+                return None
+            self._read_waiter = asyncio.get_event_loop().create_future()
+            await self._read_waiter
+        event = self.events.popleft()
+        if len(self.events) <= self.max_queued // 2:
+            if self._unread is not None:
+                self._pull()
+            if self._reading_paused and self._unread is None:
+                self._reading_paused = False
+                self.transport.resume_reading()
+        return event
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self.read_event()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    def _pull(self):
+        ''' queue events from the unread reads until max_queued are waiting, stop reading
+            from the socket if that leaves some
+        '''
+        events, queue, limit = self._unread, self.events, self.max_queued
+        while len(queue) < limit:
+            event = next(events, None)
+            if event is None:
+                self._unread = None
+                break
+            queue.append(event)
+        self.flush()
+        if len(queue) >= limit and not self._reading_paused:
+            self._reading_paused = True
+            self.transport.pause_reading()
+
+    # writing
+
+    def write(self, data):
+        ''' send text, escaping any IACs in it '''
+        self.stream.send_text(data)
+        self.flush()
+
+    def write_prompt(self, text):
+        ''' send a prompt that ends in IAC GA or IAC EOR, see TelnetStream.send_prompt() '''
+        self.stream.send_prompt(text)
+        self.flush()
+
+    def flush(self):
+        ''' write everything the stream has pending in one go '''
+        stream = self.stream
+        if stream.outbuf and self.transport is not None and not self.closed:
+            self.transport.write(stream.take_data())
+
+    async def drain(self):
+        ''' wait until the transport's write buffer is below its low-water mark '''
+        if self.exception is not None:
+            raise self.exception
+        if self._writing_paused and not self.closed:
+            waiter = asyncio.get_event_loop().create_future()
+            self._drain_waiters.append(waiter)
+            await waiter
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+
+    async def wait_closed(self):
+        if self._closed_waiter is not None:
+            await self._closed_waiter
+
+    def _close(self, exc):
+        if self.closed:
+            return
+        self.closed = True
+        self.exception = exc
+        self._wake(self._read_waiter)
+        self._read_waiter = None
+        self.resume_writing()
+        self._wake(self._closed_waiter)
+
+    @staticmethod
+    def _wake(waiter):
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+
+async def open_connection(host, port, stream=None, **kwargs):
+    ''' connect to a telnet server, return the connected TelnetProtocol.
+        kwargs are passed to loop.create_connection()
+    '''
+    loop = asyncio.get_event_loop()
+    transport, protocol = await loop.create_connection(lambda: TelnetProtocol(stream), host, port, **kwargs)
+    return protocol
+
+
+async def start_server(client_connected_cb, host=None, port=None, stream_factory=None, **kwargs):
+    ''' start a telnet server, client_connected_cb(protocol) is called for every new connection
+        and may be a coroutine function. stream_factory() makes the TelnetStream for each
+        connection, the default is TelnetStream.make_server. kwargs are passed to loop.create_server()
+    '''
+    loop = asyncio.get_event_loop()
+    if stream_factory is None:
+        stream_factory = telneter.TelnetStream.make_server
+
+    def factory():
+        return TelnetProtocol(stream_factory(), client_connected_cb)
+
+    return await loop.create_server(factory, host, port, **kwargs)
@@ -0,0 +1,269 @@
+'''
+Record what a TelnetStream was sent, and replay it.
+
+A capture file is a header and then one record per chunk, each with the microseconds
+since the record before it, the length, and the direction (IN for what we received,
+OUT for what we sent). With compress=True each record is compressed and flushed into
+a segment with its length, and each Recorder starts a new zlib stream. A crash loses at
+most the record being written: appending cuts off a half written record or segment
+first, and reading starts over at the next zlib stream if one is corrupt.
+
+    stream = RecordingStream(recorder=Recorder.open('session.cap'))
+
+and later
+
+    python3 telneter_capture.py session.cap --streams 100
+'''
+
+import argparse
+import mmap
+import struct
+import sys
+import time
+import zlib
+
+import telneter
+
+MAGIC = b'TELCAP2'
+# header flags
+COMPRESSED = 1
+HEADER = struct.Struct('<7sB')  # MAGIC, flags
+# microseconds since the last record, length, direction
+RECORD = struct.Struct('<IIB')
+MAX_DELTA = 0xffffffff  # about 71 minutes, longer pauses are recorded as that
+# compressed captures are segments of zlib output instead: whether the segment starts
+# a new zlib stream, and the length
+SEGMENT = struct.Struct('<BI')
+
+# directions
+IN, OUT = 0, 1
+
+
+class Recorder(object):
+    ''' Appends records to a binary file. '''
+
+    def __init__(self, f, compress=False, clock=time.perf_counter):
+        self.f = f
+        self.clock = clock
+        self.last = clock()
+        if f.tell() == 0:
+            f.write(HEADER.pack(MAGIC, COMPRESSED if compress else 0))
+        self.compressor = zlib.compressobj() if compress else None
+        self.new_stream = True
+
+    @classmethod
+    def open(cls, path, compress=False, **kwargs):
+        ''' append to the capture at path, or start it. An existing capture keeps its compression. '''
+        f = open(path, 'ab')
+        if f.tell():
+            with open(path, 'rb') as existing:
+                data = mmap.mmap(existing.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    compress = bool(read_header(data) & COMPRESSED)
+                    size = complete_size(data, compress)
+                finally:
+                    data.close()
+            # if we crashed writing the last record, what we append would be read as the rest of it
+            f.truncate(size)
+        return cls(f, compress, **kwargs)
+
+    def write(self, direction, data):
+        now = self.clock()
+        delta = min(int((now - self.last) * 1000000), MAX_DELTA)
+        self.last = now
+        record = RECORD.pack(delta, len(data), direction) + data
+        if self.compressor is not None:
+            record = self._segment(self.compressor.compress(record) + self.compressor.flush(zlib.Z_SYNC_FLUSH))
+        self.f.write(record)
+
+    def _segment(self, data):
+        segment = SEGMENT.pack(self.new_stream, len(data)) + data
+        self.new_stream = False
+        return segment
+
+    def close(self):
+        if self.compressor is not None:
+            self.f.write(self._segment(self.compressor.flush()))
+            self.compressor = None
+        self.f.close()
+
+
+def read_header(data):
+    ''' return the flags from a capture header '''
+    if len(data) < HEADER.size:
+        raise ValueError('not a capture file, too short')
+    magic, flags = HEADER.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError('not a capture file, bad magic %r' % magic)
+    return flags
+
+
+def complete_size(data, compressed):
+    ''' the length of the capture in data up to the end of the last record (or segment, if
+        compressed) that was written in full
+    '''
+    head = SEGMENT if compressed else RECORD
+    i, end = HEADER.size, len(data)
+    while i + head.size <= end:
+        length = head.unpack_from(data, i)[1]  # both have the length second
+        if i + head.size + length > end:
+            break
+        i += head.size + length
+    return i
+
+
+class RecordingStream(telneter.TelnetStream):
+    ''' a TelnetStream that records everything it receives, and everything it sends
+        as it is consume()d, if recorder is set
+    '''
+    __slots__ = ('recorder',)
+
+    def __init__(self, state=None, compressor=None, recorder=None):
+        telneter.TelnetStream.__init__(self, state, compressor)
+        self.recorder = recorder
+
+    def events(self, data):
+        if self.recorder is not None:
+            self.recorder.write(IN, data)
+        return telneter.TelnetStream.events(self, data)
+
+    def consume(self, n):
+        if self.recorder is not None:
+            self.recorder.write(OUT, bytes(self.outbuf[:n]))
+        telneter.TelnetStream.consume(self, n)
+
+    def take_data(self):
+        data = telneter.TelnetStream.take_data(self)
+        if self.recorder is not None:
+            self.recorder.write(OUT, bytes(data))
+        return data
+
+
+class Capture(object):
+    ''' A capture file, memory mapped. Iterating gives (seconds since the start, direction, data). '''
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.flags = read_header(f.read(HEADER.size))
+            if f.seek(0, 2) == HEADER.size:
+                self.data = b''  # mmap won't map nothing
+            else:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        # [(records, where they start)], one for each zlib stream if compressed
+        if self.flags & COMPRESSED:
+            self.streams = [(data, 0) for data in _decompress_streams(self.data[HEADER.size:])]
+        else:
+            self.streams = [(self.data, HEADER.size)]
+
+    def __iter__(self):
+        when = 0.0
+        for data, i in self.streams:
+            end = len(data)
+            while i + RECORD.size <= end:
+                delta, length, direction = RECORD.unpack_from(data, i)
+                i += RECORD.size
+                if i + length > end:
+                    break  # the last record was cut short
+                when += delta / 1000000.0
+                yield when, direction, data[i:i+length]
+                i += length
+
+    def chunks(self, direction=IN):
+        ''' return [(seconds since the start, data)] for one direction '''
+        return [(when, data) for when, chunk_direction, data in self if chunk_direction == direction]
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap):
+            self.data.close()
+
+
+def _decompress_streams(data):
+    ''' Decompress the segments Recorder wrote, return a list of the records in each zlib
+        stream. A stream that ends without finishing (we crashed) or turns out to be corrupt
+        keeps everything before that point, the streams after it are read as usual.
+    '''
+    streams = []
+    decompressor = None
+    i, end = 0, len(data)
+    while i + SEGMENT.size <= end:
+        new_stream, length = SEGMENT.unpack_from(data, i)
+        i += SEGMENT.size
+        if i + length > end:
+            break  # we crashed in the middle of writing it
+        if new_stream:
+            decompressor = zlib.decompressobj()
+            parts = []
+            streams.append(parts)
+        if decompressor is not None:
+            try:
+                parts.append(decompressor.decompress(data[i:i+length]))
+            except zlib.error:
+                decompressor = None  # skip to the next stream
+        i += length
+    return [b''.join(parts) for parts in streams]
+
+
+def percentile(values, pct):
+    ''' nearest rank percentile of an already sorted list '''
+    return values[int(round(pct / 100.0 * (len(values) - 1)))]
+
+
+def replay(chunks, streams=1, pace=False, stream_factory=telneter.TelnetStream, clock=time.perf_counter):
+    ''' Push the IN chunks from Capture.chunks() through streams fresh TelnetStreams, each
+        chunk to every stream before the next chunk, with the original chunk boundaries.
+        pace=True waits until each chunk's recorded time, otherwise it goes as fast as it can.
+        return a dict of totals, rates, and per-chunk latency percentiles in microseconds.
+    '''
+    sessions = [stream_factory() for i in range(streams)]
+    latencies = []
+    events = 0
+    start = clock()
+    for when, data in chunks:
+        if pace:
+            wait = when - (clock() - start)
+            if wait > 0:
+                time.sleep(wait)
+        for stream in sessions:
+            before = clock()
+            for event in stream.events(data):  # not feed(), a list of everything could be huge
+                events += 1
+            latencies.append(clock() - before)
+            del stream.outbuf[:]  # nobody is listening
+    seconds = max(clock() - start, 1e-9)
+    latencies.sort()
+    total = sum(len(data) for when, data in chunks) * streams
+    report = {
+        'streams': streams,
+        'chunks': len(latencies),
+        'bytes': total,
+        'events': events,
+        'seconds': seconds,
+        'events_per_sec': events / seconds,
+        'mb_per_sec': total / seconds / (1024 * 1024),
+    }
+    for pct in (50, 90, 99):
+        report['latency_p%d_us' % pct] = percentile(latencies, pct) * 1000000 if latencies else 0.0
+    report['latency_max_us'] = latencies[-1] * 1000000 if latencies else 0.0
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='replay a telneter capture file')
+    parser.add_argument('path')
+    parser.add_argument('--streams', type=int, default=1, help='TelnetStreams to push the capture through')
+    parser.add_argument('--pace', action='store_true', help='replay at the recorded pace')
+    parser.add_argument('--server', action='store_true', help='use TelnetStream.make_server streams')
+    args = parser.parse_args(argv)
+
+    capture = Capture(args.path)
+    chunks = capture.chunks(IN)
+    capture.close()
+    factory = telneter.TelnetStream.make_server if args.server else telneter.TelnetStream
+    report = replay(chunks, args.streams, args.pace, factory)
+    for name, value in report.items():
+        print('%-16s %14.3f' % (name, value))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
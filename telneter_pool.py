@@ -0,0 +1,328 @@
+'''
+A pool of worker processes that own the TelnetStreams, so parsing a lot of busy
+connections can use more than one core.
+
+Sessions are sharded by connection id (an int) and never move, so all of a session's
+state stays in the worker that made it. Chunks go to each worker through a shared
+memory buffer, and the events and replies come back through another. The pipes only
+carry a few bytes saying how much of a buffer to read.
+
+    with SessionPool(workers=4) as pool:
+        for conn_id, events, outbound in pool.feed([(conn_id, data), ...]):
+            ...
+'''
+
+import multiprocessing
+import os
+import pickle
+import struct
+from multiprocessing import shared_memory
+
+import telneter
+
+# bytes in each shared memory buffer, a worker gets one for input and one for output
+BUFFER_SIZE = 4 * 1024 * 1024
+
+# input records: conn_id, length, then the data
+CHUNK = struct.Struct('<QI')
+# output records: conn_id, length of the encoded events, length of outbound,
+# then the events and the outbound bytes
+RESULT = struct.Struct('<QII')
+# encoded events: a kind byte, then for text the length and text, for a command the cmd,
+# the option (NO_OPTION for None) and the sb_data length and sb_data, and for anything
+# else the length of the pickle and the pickle
+TEXT, COMMAND, PICKLED = 0, 1, 2
+TEXT_HEAD = struct.Struct('<BI')
+COMMAND_HEAD = struct.Struct('<BBHI')
+NO_OPTION = 256
+
+# messages on the pipes, an op byte and a length
+MESSAGE = struct.Struct('<cQ')
+BATCH = b'B'  # parse the first n bytes of the input buffer
+CLOSE = b'C'  # forget these sessions, the conn ids are in the message
+QUIT = b'Q'
+RESULTS = b'R'  # the results are the first n bytes of the output buffer
+OVERFLOW = b'O'  # the results didn't fit, they are in the rest of this message
+
+
+def encode_events(events):
+    ''' return events as bytes for decode_events(), much cheaper than pickling namedtuples '''
+    TextEvent, CommandEvent = telneter.TextEvent, telneter.CommandEvent
+    text_head, command_head = TEXT_HEAD.pack, COMMAND_HEAD.pack
+    parts = []
+    append = parts.append
+    for event in events:
+        cls = event.__class__
+        if cls is TextEvent:
+            append(text_head(TEXT, len(event.text)))
+            append(event.text)
+        elif cls is CommandEvent:
+            option = NO_OPTION if event.option is None else ord(event.option)
+            append(command_head(COMMAND, ord(event.cmd), option, len(event.sb_data)))
+            append(event.sb_data)
+        else:
+            pickled = pickle.dumps(event, pickle.HIGHEST_PROTOCOL)
+            append(text_head(PICKLED, len(pickled)))
+            append(pickled)
+    return b''.join(parts)
+
+
+def decode_events(data, start=0, end=None):
+    ''' return the list of events encode_events() made data[start:end] from '''
+    BYTES = telneter.BYTES
+    TextEvent, CommandEvent = telneter.TextEvent, telneter.CommandEvent
+    # skips the namedtuple's python __new__, it is a third of the time otherwise
+    new = tuple.__new__
+    text_head, text_size = TEXT_HEAD.unpack_from, TEXT_HEAD.size
+    command_head, command_size = COMMAND_HEAD.unpack_from, COMMAND_HEAD.size
+    if end is None:
+        end = len(data)
+    events = []
+    append = events.append
+    i = start
+    while i < end:
+        kind = data[i]
+        if kind == TEXT:
+            kind, length = text_head(data, i)
+            i += text_size
+            append(new(TextEvent, (data[i:i+length],)))
+        elif kind == COMMAND:
+            kind, cmd, option, length = command_head(data, i)
+            i += command_size
+            append(new(CommandEvent, (BYTES[cmd], None if option == NO_OPTION else BYTES[option],
+                                      data[i:i+length])))
+        else:
+            kind, length = text_head(data, i)
+            i += text_size
+            append(pickle.loads(data[i:i+length]))
+        i += length
+    return events
+
+
+class Events(object):
+    ''' The events encoded in data[start:end], decoded the first time they are looked at.
+        Compares equal to the list of events, encoded() is the raw encoding for callers
+        that would rather ship it on than decode it here.
+    '''
+    __slots__ = ('data', 'start', 'end', '_events')
+
+    def __init__(self, data, start=0, end=None):
+        self.data = data
+        self.start = start
+        self.end = len(data) if end is None else end
+        self._events = None
+
+    def encoded(self):
+        if self.data is None:
+            return encode_events(self._events)
+        return self.data[self.start:self.end]
+
+    def decoded(self):
+        if self._events is None:
+            self._events = decode_events(self.data, self.start, self.end)
+            self.data = None  # don't keep the whole batch alive for one connection
+        return self._events
+
+    def __iter__(self):
+        return iter(self.decoded())
+
+    def __len__(self):
+        return len(self.decoded())
+
+    def __getitem__(self, index):
+        return self.decoded()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, Events):
+            other = other.decoded()
+        return self.decoded() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def __repr__(self):
+        return 'Events(%r)' % (self.decoded(),)
+
+
+def _attach(name):
+    ''' open the parent's shared memory, the parent unlinks it '''
+    try:
+        return shared_memory.SharedMemory(name, track=False)  # python 3.13+
+    except TypeError:
+        # workers share the parent's resource tracker, so registering it again is harmless
+        return shared_memory.SharedMemory(name)
+
+
+def _worker(conn, in_name, out_name, stream_factory):
+    ''' the loop each worker process runs, it owns every session sharded to it '''
+    inbuf, outbuf = _attach(in_name), _attach(out_name)
+    out_size = outbuf.size
+    sessions = {}
+    try:
+        while True:
+            message = conn.recv_bytes()
+            op, n = MESSAGE.unpack_from(message)
+            if op == QUIT:
+                break
+            if op == CLOSE:
+                for conn_id in struct.unpack_from('<%dQ' % n, message, MESSAGE.size):
+                    sessions.pop(conn_id, None)
+                continue
+
+            data = inbuf.buf
+            parts = []
+            i = 0
+            while i < n:
+                conn_id, length = CHUNK.unpack_from(data, i)
+                i += CHUNK.size
+                stream = sessions.get(conn_id)
+                if stream is None:
+                    stream = sessions[conn_id] = stream_factory()
+                # encoded as they are made, not feed()'s list of every event
+                encoded = encode_events(stream.events(bytes(data[i:i+length])))
+                i += length
+                outbound = bytes(stream.outbuf)
+                del stream.outbuf[:]
+                parts.append(RESULT.pack(conn_id, len(encoded), len(outbound)))
+                parts.append(encoded)
+                parts.append(outbound)
+            del data
+            results = b''.join(parts)
+            if len(results) <= out_size:
+                outbuf.buf[:len(results)] = results
+                conn.send_bytes(MESSAGE.pack(RESULTS, len(results)))
+            else:
+                conn.send_bytes(MESSAGE.pack(OVERFLOW, len(results)) + results)
+    finally:
+        inbuf.close()
+        outbuf.close()
+
+
+def default_workers():
+    ''' one worker for every core we are allowed to run on '''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+class SessionPool(object):
+    ''' Worker processes that own TelnetStreams (made by stream_factory, which has to be
+        picklable unless multiprocessing forks) keyed by an int connection id.
+    '''
+
+    def __init__(self, workers=None, stream_factory=telneter.TelnetStream, buffer_size=BUFFER_SIZE):
+        if workers is None:
+            workers = default_workers()
+        self.buffer_size = buffer_size
+        # [(process, pipe, input buffer, output buffer)]
+        self.workers = []
+        context = multiprocessing.get_context()
+        for i in range(workers):
+            inbuf = shared_memory.SharedMemory(create=True, size=buffer_size)
+            outbuf = shared_memory.SharedMemory(create=True, size=buffer_size)
+            ours, theirs = context.Pipe()
+            process = context.Process(target=_worker, args=(theirs, inbuf.name, outbuf.name, stream_factory),
+                                      daemon=True)
+            process.start()
+            theirs.close()
+            self.workers.append((process, ours, inbuf, outbuf))
+
+    def shard(self, conn_id):
+        ''' the worker that owns conn_id, always the same one '''
+        return conn_id % len(self.workers)
+
+    def feed(self, batch):
+        ''' Feed a batch of (conn_id, data) to the sessions, making any that are new.
+            return [(conn_id, events, outbound bytes)] in the same order as the batch, events
+            is an Events that decodes on first use.
+            A conn_id can be in the batch more than once, its chunks are fed in order.
+        '''
+        results = [None] * len(batch)
+        # for each worker, [(index in batch, conn_id, data)] still to send
+        pending = [[] for worker in self.workers]
+        room = self.buffer_size - CHUNK.size
+        for index, (conn_id, data) in enumerate(batch):
+            # anything too big for the buffer goes in pieces, the parser doesn't care
+            pieces = [data[i:i+room] for i in range(0, len(data), room)] or [data]
+            for piece in pieces:
+                pending[self.shard(conn_id)].append((index, conn_id, piece))
+
+        while any(pending):
+            sent = []
+            for worker, chunks in zip(self.workers, pending):
+                if chunks:
+                    sent.append((worker, self._send(worker, chunks)))
+            for worker, indexes in sent:
+                self._receive(worker, indexes, results)
+        return results
+
+    def _send(self, worker, chunks):
+        ''' write as many chunks as fit into the worker's buffer and start it on them,
+            return the batch indexes it will answer for
+        '''
+        process, pipe, inbuf, outbuf = worker
+        buf = inbuf.buf
+        i = 0
+        indexes = []
+        for index, conn_id, data in chunks:
+            if i + CHUNK.size + len(data) > self.buffer_size:
+                break
+            CHUNK.pack_into(buf, i, conn_id, len(data))
+            i += CHUNK.size
+            buf[i:i+len(data)] = data
+            i += len(data)
+            indexes.append(index)
+        # one delete for the lot, popping the front each time is quadratic in the batch
+        del chunks[:len(indexes)]
+        pipe.send_bytes(MESSAGE.pack(BATCH, i))
+        return indexes
+
+    def _receive(self, worker, indexes, results):
+        process, pipe, inbuf, outbuf = worker
+        message = pipe.recv_bytes()
+        op, n = MESSAGE.unpack_from(message)
+        # one copy out of the buffer, slicing bytes is cheaper than making memoryviews
+        data = outbuf.buf[:n].tobytes() if op == RESULTS else message[MESSAGE.size:]
+        i = 0
+        for index in indexes:
+            conn_id, events_size, outbound_size = RESULT.unpack_from(data, i)
+            i += RESULT.size
+            # decoded by whoever reads them, so the parent isn't stuck building every event
+            events = Events(data, i, i + events_size)
+            i += events_size
+            outbound = data[i:i+outbound_size]
+            i += outbound_size
+            if results[index] is None:
+                results[index] = (conn_id, events, outbound)
+            else:  # the next piece of a big chunk
+                conn_id, before, before_outbound = results[index]
+                results[index] = (conn_id, Events(before.encoded() + events.encoded()), before_outbound + outbound)
+
+    def close_sessions(self, conn_ids):
+        ''' forget the sessions for conn_ids, e.g. once their connections closed '''
+        shards = [[] for worker in self.workers]
+        for conn_id in conn_ids:
+            shards[self.shard(conn_id)].append(conn_id)
+        for (process, pipe, inbuf, outbuf), ids in zip(self.workers, shards):
+            if ids:
+                pipe.send_bytes(MESSAGE.pack(CLOSE, len(ids)) + struct.pack('<%dQ' % len(ids), *ids))
+
+    def close(self):
+        ''' stop the workers and free the shared memory '''
+        for process, pipe, inbuf, outbuf in self.workers:
+            pipe.send_bytes(MESSAGE.pack(QUIT, 0))
+        for process, pipe, inbuf, outbuf in self.workers:
+            process.join()
+            pipe.close()
+            for shm in (inbuf, outbuf):
+                shm.close()
+                shm.unlink()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -1,10 +1,19 @@
-from __future__ import print_function
-
-import mock
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
 import unittest
+import zlib
+from unittest import mock
 import telneter
 import find_IACSE
-from telneter import IAC, SB, SE, WILL, WONT, DO, DONT, STATUS
+import asyncio
+import telneter_aio
+import telneter_capture
+import telneter_pool
+from telneter import IAC, SB, SE, WILL, WONT, DO, DONT, STATUS, NOP, IAC_escape
 
 
 def multi_parse(data):
@@ -15,22 +24,41 @@ def multi_parse(data):
     return parses
 
 
+def deep_sizeof(obj, seen=None):
+    ''' sys.getsizeof() of obj and everything it holds that isn't shared with other sessions '''
+    if seen is None:
+        seen = set()
+    shared = (bytes, str, int, bool, float, type(None), type(len), type(deep_sizeof), telneter.SharedHandlers)
+    if id(obj) in seen or isinstance(obj, shared):
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_sizeof(k, seen) + deep_sizeof(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(deep_sizeof(v, seen) for v in obj)
+    for cls in type(obj).__mro__:
+        for name in cls.__dict__.get('__slots__', ()):
+            size += deep_sizeof(getattr(obj, name, None), seen)
+    return size + deep_sizeof(getattr(obj, '__dict__', None), seen)
+
+
 class TelnetParser(unittest.TestCase):
     def test_IAC_escapes(self):
         IAC = telneter.IAC
         self.assertEqual(IAC+IAC, telneter.IAC_escape(IAC))
         self.assertEqual(IAC+IAC+IAC+IAC, telneter.IAC_escape(IAC+IAC))
-        self.assertEqual('hello', telneter.IAC_escape('hello'))
+        self.assertEqual(b'hello', telneter.IAC_escape(b'hello'))
 
-        self.assertEqual(IAC+SB+STATUS+'hello'+IAC+SE,
-                         telneter.construct_control(SB, STATUS, 'hello'))
+        self.assertEqual(IAC+SB+STATUS+b'hello'+IAC+SE,
+                         telneter.construct_control(SB, STATUS, b'hello'))
         self.assertEqual(IAC+SB+STATUS+IAC+IAC+IAC+SE,
                          telneter.construct_control(SB, STATUS, IAC))
 
     def test_parse_plain(self):
-        for line in ['xxxxx', 'yyyyy', 'xyz', 
-                     '\0x\0y\0', '\nx\ny',  # nulls & newlines
-                     '\xe2\x98\xaf \xe2\x98\xad \xe2\x9a\xa1',  # dat unicode
+        for line in [b'xxxxx', b'yyyyy', b'xyz', 
+                     b'\0x\0y\0', b'\nx\ny',  # nulls & newlines
+                     b'\xe2\x98\xaf \xe2\x98\xad \xe2\x9a\xa1',  # dat unicode
                     ]:
             self.assertEqual((None, line, b''), telneter.parse(line))
 
@@ -46,11 +74,11 @@ class TelnetParser(unittest.TestCase):
         self.assertEqual([((WILL, STATUS, b''), b'', mock.ANY),
                           (None, b'text', mock.ANY),
                           ((DO, STATUS, b''), b'', b'')],
-                         multi_parse(IAC+WILL+STATUS + 'text' + IAC+DO+STATUS))
-        self.assertEqual([(None, 'before', mock.ANY),
+                         multi_parse(IAC+WILL+STATUS + b'text' + IAC+DO+STATUS))
+        self.assertEqual([(None, b'before', mock.ANY),
                           ((WILL, STATUS, b''), b'', mock.ANY),
-                          (None, 'after', b'')],
-                         multi_parse(b'before' + IAC+WILL+STATUS + 'after'))
+                          (None, b'after', b'')],
+                         multi_parse(b'before' + IAC+WILL+STATUS + b'after'))
 
     def test_find_IACSE(self):
         for func in find_IACSE.all_finders:
@@ -64,28 +92,855 @@ class TelnetParser(unittest.TestCase):
             #                                   ^^^^^^
             self.assertEqual(2, func(IAC+IAC+IAC+SE))
             #                                ^^^^^^
-            data = IAC+SB+STATUS+'xxx'+IAC+IAC+'xxx'+IAC+IAC + IAC+SE
+            data = IAC+SB+STATUS+b'xxx'+IAC+IAC+b'xxx'+IAC+IAC + IAC+SE
             #                                                  ^^^^^^
             self.assertEqual(13, func(data))
-            self.assertEqual(6, func(IAC+IAC+SE+'xxx'+IAC+SE))
+            self.assertEqual(6, func(IAC+IAC+SE+b'xxx'+IAC+SE))
             #                                         ^^^^^^
-            self.assertEqual(9, func(IAC+IAC+SE+'xxx'+IAC+IAC+SE+IAC+SE))
+            self.assertEqual(9, func(IAC+IAC+SE+b'xxx'+IAC+IAC+SE+IAC+SE))
             #                                                    ^^^^^^
-            self.assertEqual(6, func(IAC+IAC+SE+'xxx'+IAC+SE+IAC+SE))
+            self.assertEqual(6, func(IAC+IAC+SE+b'xxx'+IAC+SE+IAC+SE))
             #                                         ^^^^^^
+        # and they all agree on the pathological cases
+        find_IACSE.cross_check()
+        with mock.patch.object(find_IACSE, 'numpy', None):  # find_numpy without numpy
+            find_IACSE.cross_check()
+        # numpy is slow to import, only find_numpy should pay for it
+        code = 'import sys, telneter; sys.exit("numpy" in sys.modules)'
+        self.assertEqual(0, subprocess.call([sys.executable, '-c', code]))
 
     def _test_parse_sb(self):
-        self.assertEqual([((SB, STATUS, 'payload'), b'', b'')],
-                         multi_parse(IAC+SB+STATUS + 'payload' + IAC+SE))
-        self.assertEqual([((SB, STATUS, 'payload'), b'', b'')],
-                         multi_parse(IAC+SB+STATUS + 'payload'+IAC+IAC + IAC+SE))
-        self.assertEqual([((SB, STATUS, 'pay'+IAC+'load'), b'', b'')],
-                         multi_parse(IAC+SB+STATUS + 'pay'+IAC+IAC+'load' + IAC+SE))
-        self.assertEqual([((SB, STATUS, 'pay'+IAC+SE+'load'), b'', b'')],
-                         multi_parse(IAC+SB+STATUS + 'pay'+IAC+IAC+SE+'load' + IAC+SE))
-        big_payload = 'x' * 1024 *1024
+        self.assertEqual([((SB, STATUS, b'payload'), b'', b'')],
+                         multi_parse(IAC+SB+STATUS + b'payload' + IAC+SE))
+        self.assertEqual([((SB, STATUS, b'payload'), b'', b'')],
+                         multi_parse(IAC+SB+STATUS + b'payload'+IAC+IAC + IAC+SE))
+        self.assertEqual([((SB, STATUS, b'pay'+IAC+b'load'), b'', b'')],
+                         multi_parse(IAC+SB+STATUS + b'pay'+IAC+IAC+b'load' + IAC+SE))
+        self.assertEqual([((SB, STATUS, b'pay'+IAC+SE+b'load'), b'', b'')],
+                         multi_parse(IAC+SB+STATUS + b'pay'+IAC+IAC+SE+b'load' + IAC+SE))
+        big_payload = b'x' * 1024 *1024
         self.assertEqual([((SB, STATUS, big_payload), b'', b'')],
                          multi_parse(IAC+SB+STATUS + big_payload + IAC+SE))
     
                 
                 
+
+    def test_resumable_parser(self):
+        TextEvent, CommandEvent = telneter.TextEvent, telneter.CommandEvent
+        data = (b'before' + IAC+WILL+STATUS + b'mid'+IAC+IAC + IAC+SB+STATUS + b'pay'+IAC+IAC+b'load' + IAC+SE +
+                IAC+telneter.NOP + b'after')
+        expected = [TextEvent(b'before'),
+                    CommandEvent(WILL, STATUS, b''),
+                    TextEvent(b'mid'+IAC),
+                    CommandEvent(SB, STATUS, b'pay'+IAC+b'load'),
+                    CommandEvent(telneter.NOP, None, b''),
+                    TextEvent(b'after')]
+        parser = telneter.TelnetParser()
+        self.assertEqual(expected, list(parser.parse(data)))
+        self.assertEqual((expected, b''), telneter.parse_all(data))
+
+        # one byte at a time, text comes out in pieces but the controls are the same
+        parser = telneter.TelnetParser()
+        parsed = []
+        for i in range(len(data)):
+            parsed.extend(parser.parse(data[i:i+1]))
+        self.assertEqual([e for e in expected if isinstance(e, CommandEvent)],
+                         [e for e in parsed if isinstance(e, CommandEvent)])
+        self.assertEqual(b'beforemid'+IAC+b'after', b''.join(e.text for e in parsed if isinstance(e, TextEvent)))
+
+    def test_resumable_parser_partial(self):
+        CommandEvent = telneter.CommandEvent
+        parser = telneter.TelnetParser()
+        self.assertEqual([], list(parser.parse(IAC+SB+STATUS+b'pay'+IAC+IAC)))
+        self.assertEqual(IAC+SB+STATUS+b'pay'+IAC+IAC, parser.unparsed_data)
+        self.assertEqual([], list(parser.parse(IAC)))
+        self.assertEqual([CommandEvent(SB, STATUS, b'pay'+IAC)], list(parser.parse(SE)))
+        self.assertEqual(b'', parser.unparsed_data)
+
+        big_payload = b'x' * 64 * 1024
+        parsed = []
+        data = IAC+SB+STATUS + big_payload + IAC+SE
+        for i in range(len(data)):
+            parsed.extend(parser.parse(data[i:i+1]))
+        self.assertEqual([CommandEvent(SB, STATUS, big_payload)], parsed)
+
+    def test_adaptive_finder(self):
+        finder = find_IACSE.AdaptiveFinder()
+        escaped = (IAC+IAC) * 1000 + IAC+IAC+SE
+        data = IAC+SB+STATUS + escaped + IAC+SE
+        self.assertEqual(len(data) - 2, finder(data))
+        self.assertEqual(find_IACSE.HOSTILE_SEARCHES, finder.hostile)
+        self.assertEqual(len(data) - 2, finder(memoryview(data)))
+        self.assertEqual(-1, finder(data, 0, len(data) - 1))
+
+        payload = IAC * 1000 + IAC+SE
+        self.assertEqual(((SB, STATUS, payload), b'x'), telneter.parse_control(data + b'x'))
+        # the stream parser gives the same answer however the data is chopped up
+        CommandEvent = telneter.CommandEvent
+        for size in [1, 2, 3, 7, 4096]:
+            parser = telneter.TelnetParser()
+            parsed = []
+            for i in range(0, len(data), size):
+                parsed.extend(parser.parse(data[i:i+size]))
+            self.assertEqual([CommandEvent(SB, STATUS, payload)], parsed, size)
+
+    def test_stream_receive_data(self):
+        stream = telneter.TelnetStream()
+        stream.receive_data(b'hi' + IAC+WILL+telneter.ECHO + IAC+DO+STATUS + IAC)
+        self.assertEqual(IAC+DO+telneter.ECHO + IAC+WONT+STATUS, stream.data_to_send())
+        self.assertEqual(IAC, stream.unparsed_data)
+
+    def test_stream_feed(self):
+        stream = telneter.TelnetStream()
+        events = stream.feed(b'a' + IAC+WILL+telneter.ECHO + b'b' + IAC+DO+STATUS + b'c')
+        self.assertEqual([telneter.TextEvent(b'a'),
+                          telneter.CommandEvent(WILL, telneter.ECHO, b''),
+                          telneter.TextEvent(b'b'),
+                          telneter.CommandEvent(DO, STATUS, b''),
+                          telneter.TextEvent(b'c')], events)
+        self.assertEqual(IAC+DO+telneter.ECHO + IAC+WONT+STATUS, stream.data_to_send())
+
+    def test_buffer_input(self):
+        data = b'x'+IAC+IAC+b'y' + IAC+SB+STATUS + b'pay'+IAC+IAC+b'load' + IAC+SE + b'rest'
+        self.assertEqual((4, True), telneter.partition_control_range(data))
+        self.assertEqual((SB, STATUS, 7, 16, True, 18), telneter.parse_control_range(data, 4))
+        self.assertEqual(None, telneter.parse_control_range(data, 4, 17))
+        self.assertEqual((WILL, STATUS, 3, 3, False, 3), telneter.parse_control_range(IAC+WILL+STATUS))
+        # two byte commands, the same as TelnetParser
+        self.assertEqual(((NOP, None, b''), b'', b'hello'), telneter.parse(IAC+NOP+b'hello'))
+        self.assertEqual(((telneter.GA, None, b''), b'', b''), telneter.parse(IAC+telneter.GA))
+        self.assertEqual((None, b'', IAC+WILL), telneter.parse(IAC+WILL))
+        self.assertEqual(None, telneter.parse_control_range(IAC))
+
+        for kind in [bytes, bytearray, memoryview]:
+            buf = kind(data)
+            text, rest = telneter.partition_control(buf)
+            self.assertEqual(b'x'+IAC+b'y', text)
+            control, unparsed = telneter.parse_control(rest)
+            self.assertEqual((SB, STATUS, b'pay'+IAC+b'load'), control)
+            self.assertEqual(b'rest', unparsed)
+            self.assertEqual((None, b'rest', b''), telneter.parse(unparsed))
+
+        # memoryviews stay memoryviews when there is nothing to unescape
+        view = memoryview(bytearray(b'text' + IAC+WILL+STATUS))
+        text, rest = telneter.partition_control(view)
+        self.assertTrue(isinstance(text, memoryview))
+        self.assertEqual(b'text', text.tobytes())
+
+    def test_sb_limit(self):
+        TextEvent, CommandEvent = telneter.TextEvent, telneter.CommandEvent
+        payload = b'x' * 100
+        data = IAC+SB+STATUS + payload + IAC+SE + b'after' + IAC+SB+STATUS + b'ok' + IAC+SE
+        # discard skips the rest of the payload, however it is chopped up
+        for size in [1, 7, len(data)]:
+            parser = telneter.TelnetParser()
+            parser.limit_subneg(STATUS, 10)
+            parsed = []
+            for i in range(0, len(data), size):
+                parsed.extend(parser.parse(data[i:i+size]))
+                self.assertTrue(len(parser.sb_buf) <= 10 + size)
+            parsed = [event for event in parsed if event != TextEvent(b'')]
+            # head is as much of the payload as we had when we noticed
+            self.assertEqual(telneter.SBOverflowEvent, parsed[0].__class__)
+            self.assertTrue(payload.startswith(parsed[0].head) and len(parsed[0].head) > 10)
+            self.assertEqual(b'after', b''.join(e.text for e in parsed if e.__class__ is TextEvent))
+            self.assertEqual(CommandEvent(SB, STATUS, b'ok'), parsed[-1])
+
+        # abort gives up on the SB right away, the rest of it is text
+        parser = telneter.TelnetParser()
+        parser.limit_subneg(None, 10, telneter.SB_ABORT)
+        parsed = list(parser.parse(IAC+SB+STATUS + payload))
+        parsed += parser.parse(b'more' + IAC+WILL+STATUS)
+        self.assertEqual(telneter.SBOverflowEvent, parsed[0].__class__)
+        self.assertEqual([TextEvent(b'more'), CommandEvent(WILL, STATUS, b'')], parsed[1:])
+
+        stream = telneter.TelnetStream()
+        stream.limit_subneg(STATUS, 10)
+        stream.receive_data(data)
+        self.assertEqual([(SB, STATUS, payload[:telneter.SB_HEAD])], stream.state.bad_commands)
+        self.assertRaises(ValueError, stream.limit_subneg, STATUS, 10, 'explode')
+
+    def test_sb_streaming(self):
+        class Collector(object):
+            def on_sb_start(self, tstate, option):
+                self.chunks = []
+                return b'start'
+            def on_sb_chunk(self, tstate, option, data):
+                self.chunks.append(data)
+            def on_sb_end(self, tstate, option):
+                self.payload = b''.join(self.chunks)
+                return b'end'
+
+        payload = (b'map data' + IAC) * 1000
+        data = b'before' + telneter.construct_control(SB, STATUS, payload) + b'after'
+        collector = Collector()
+        stream = telneter.TelnetStream()
+        stream.stream_subneg(STATUS, collector)
+        events = []
+        for i in range(0, len(data), 1000):
+            events.extend(stream.feed(data[i:i+1000]))
+        self.assertEqual(payload, collector.payload)
+        self.assertTrue(len(collector.chunks) > 1)
+        self.assertEqual(b'startend', stream.data_to_send())
+        self.assertEqual(telneter.TextEvent(b'before'), events[0])
+        self.assertEqual(telneter.SBStartEvent(STATUS), events[1])
+        self.assertEqual(telneter.SBEndEvent(STATUS), events[-2])
+        self.assertEqual(telneter.TextEvent(b'after'), events[-1])
+
+    def test_line_assembler(self):
+        lines = telneter.LineAssembler()
+        for chunk in [b'hel', b'lo\r', b'\nwor\0ld\n\r', b'over\r\0write\x01\n', b'prompt> ']:
+            lines.feed(chunk)
+        self.assertEqual([b'hello', b'world', b'over\rwrite'], lines.read())
+        self.assertEqual([], lines.read())
+        self.assertEqual(b'prompt> ', lines.partial)
+        lines.feed(b'look\r\n')
+        self.assertEqual([b'prompt> look'], lines.read())
+        self.assertEqual(b'', lines.partial)
+        self.assertEqual(b'ab', telneter.clean_data(b'a\0\021b'))
+
+        # a character split between two reads
+        text = u'caf\xe9 \u20ac\r\n> '.encode('utf-8')
+        stream = telneter.TelnetStream()
+        stream.assemble_lines('utf-8')
+        for i in range(len(text)):
+            stream.receive_data(text[i:i+1] + IAC+NOP)
+        self.assertEqual([u'caf\xe9 \u20ac'], stream.read_lines())
+        self.assertEqual(u'> ', stream.text.partial)
+
+    def test_prompts(self):
+        TelnetStream, PromptEvent = telneter.TelnetStream, telneter.PromptEvent
+        GA, EOR, TELOPT_EOR = telneter.GA, telneter.EOR, telneter.TELOPT_EOR
+        client = TelnetStream()
+        client.assemble_lines()
+        events = client.feed(b'room\r\n> ' + IAC+GA + b'hp 5 ' + IAC+EOR + IAC+WILL+TELOPT_EOR)
+        self.assertEqual([PromptEvent(b'> '), PromptEvent(b'hp 5 ')],
+                         [event for event in events if event.__class__ is PromptEvent])
+        self.assertEqual([b'room'], client.read_lines())
+        self.assertEqual(IAC+DO+TELOPT_EOR, client.data_to_send())
+        self.assertEqual([], client.state.bad_commands)
+
+        # the server uses EOR once the client agrees to it, GA until then
+        server = TelnetStream(telneter.TelnetState())
+        server.send_prompt(b'> ')
+        self.assertEqual(b'> ' + IAC+GA, server.data_to_send())
+        server.consume(len(server.outbuf))
+        server.offer(TELOPT_EOR)
+        server.receive_data(IAC+DO+TELOPT_EOR)
+        server.send_prompt(b'> ')
+        self.assertEqual(IAC+WILL+TELOPT_EOR + b'> ' + IAC+EOR, server.data_to_send())
+
+    def test_MCCP2(self):
+        MCCP2 = telneter.MCCP2
+        compress = zlib.compressobj()
+        compressed = compress.compress(b'zipped' + IAC+WILL+telneter.ECHO + b'text') + compress.flush()
+        # compression starts in the middle of a read and ends with plain text after it
+        data = b'plain' + IAC+SB+MCCP2+IAC+SE + compressed + b'after' + IAC+DO+STATUS
+
+        for chunk_size in [len(data), 7, 1]:
+            stream = telneter.TelnetStream()
+            stream.receive_data(IAC+WILL+MCCP2)
+            self.assertEqual(IAC+DO+MCCP2, stream.data_to_send())
+            events = []
+            for i in range(0, len(data), chunk_size):
+                events.extend(stream.feed(data[i:i+chunk_size]))
+            text = b''.join(e.text for e in events if isinstance(e, telneter.TextEvent))
+            self.assertEqual(b'plainzippedtextafter', text)
+            self.assertEqual(IAC+DO+MCCP2 + IAC+DO+telneter.ECHO + IAC+WONT+STATUS, stream.data_to_send())
+            self.assertEqual(None, stream.parser.decompressor)
+
+        # if we didn't agree to compression we don't decompress
+        stream = telneter.TelnetStream(telneter.TelnetState())
+        stream.receive_data(IAC+WILL+MCCP2 + IAC+SB+MCCP2+IAC+SE + b'text')
+        self.assertEqual(IAC+DONT+MCCP2, stream.data_to_send())
+        self.assertEqual(None, stream.parser.decompressor)
+
+    def test_MCCP2_bomb(self):
+        stream = telneter.TelnetStream()
+        stream.parser.max_inflate = 1024
+        stream.feed(IAC+WILL+telneter.MCCP2 + IAC+SB+telneter.MCCP2+IAC+SE)
+        bomb = zlib.compress(b'x' * 1024 * 1024)
+        sizes = [len(e.text) for e in stream.events(bomb)]
+        self.assertEqual(1024 * 1024, sum(sizes))
+        self.assertEqual(1024, max(sizes))
+
+    def test_MCCP2_corrupt(self):
+        stream = telneter.TelnetStream()
+        stream.feed(IAC+WILL+telneter.MCCP2 + IAC+SB+telneter.MCCP2+IAC+SE)
+        garbage = b'not zlib at all'
+        events = stream.feed(garbage)
+        self.assertEqual(1, len(events))
+        self.assertEqual(telneter.DecompressErrorEvent, events[0].__class__)
+        self.assertEqual(garbage, events[0].head)
+        self.assertEqual([(SB, None, garbage)], stream.state.bad_commands)
+        self.assertEqual(None, stream.parser.decompressor)
+        # the session carries on, as plain telnet
+        self.assertEqual([telneter.TextEvent(b'hello')], stream.feed(b'hello'))
+
+        # a bad checksum at the end of a good stream
+        stream = telneter.TelnetStream()
+        stream.feed(IAC+WILL+telneter.MCCP2 + IAC+SB+telneter.MCCP2+IAC+SE)
+        compressed = zlib.compress(b'hello')
+        self.assertEqual([telneter.TextEvent(b'hello')], stream.feed(compressed[:-4]))
+        events = stream.feed(b'\0' * 4 + b'after')
+        self.assertEqual([telneter.DecompressErrorEvent], [e.__class__ for e in events])
+        self.assertEqual([telneter.TextEvent(b'after')], stream.feed(b'after'))
+
+    def test_MCCP2_server(self):
+        MCCP2, GA = telneter.MCCP2, telneter.GA
+        server = telneter.TelnetStream.make_server(flush=telneter.FLUSH_PROMPT)
+        self.assertEqual(IAC+WILL+MCCP2 + IAC+WILL+telneter.MCCP3, server.data_to_send())
+        client = telneter.TelnetStream()
+        client.receive_data(server.data_to_send())
+        self.assertEqual(IAC+DO+MCCP2 + IAC+DONT+telneter.MCCP3, client.data_to_send())
+
+        server.consume(6)
+        server.receive_data(client.data_to_send()[:3])
+        self.assertEqual(IAC+SB+MCCP2+IAC+SE, server.data_to_send())
+        # asking again doesn't restart it
+        server.receive_data(IAC+DO+MCCP2)
+        self.assertEqual(IAC+SB+MCCP2+IAC+SE, server.data_to_send())
+
+        text = b'You are standing in an open field west of a white house. ' * 20
+        server.send(text)
+        server.send(b'> ' + IAC+GA)
+        server.send(text)
+        server.stop_compression()
+        server.send(b'plain again')
+        self.assertTrue(server.compressor.ratio < 0.1, server.compressor.ratio)
+        self.assertEqual(len(text) * 2 + 4, server.compressor.bytes_in)
+
+        events = client.feed(server.data_to_send())
+        received = b''.join(e.text for e in events if isinstance(e, telneter.TextEvent))
+        self.assertEqual(text + b'> ' + text + b'plain again', received)
+        self.assertIn(telneter.CommandEvent(GA, None, b''), events)
+
+    def test_compressor_flush_policies(self):
+        now = [0]
+        compressor = telneter.Compressor(flush=telneter.FLUSH_TIME, flush_interval=1, clock=lambda: now[0])
+        compressor.start()
+        decompress = zlib.decompressobj()
+        self.assertEqual(b'', decompress.decompress(compressor.compress(b'hello')))
+        now[0] = 2
+        self.assertEqual(b'hello there', decompress.decompress(compressor.compress(b' there')))
+        self.assertRaises(ValueError, telneter.Compressor, flush='never')
+
+    def test_compressed_replies(self):
+        # replies to the other end can't wait in zlib for the next prompt
+        server = telneter.TelnetStream.make_server(flush=telneter.FLUSH_PROMPT)
+        server.receive_data(IAC+DO+telneter.MCCP2)
+        server.consume(len(server.outbuf))
+        server.receive_data(IAC+DO+telneter.NAWS + IAC+telneter.AYT)
+        decompress = zlib.decompressobj()
+        self.assertEqual(IAC+WONT+telneter.NAWS + b'I Am Here', decompress.decompress(server.data_to_send()))
+
+        # the client changes its mind, the compressed stream ends and the rest is plain
+        server.consume(len(server.outbuf))
+        server.receive_data(IAC+DONT+telneter.MCCP2)
+        server.send_text(b'plain')
+        self.assertEqual(b'', decompress.decompress(server.data_to_send()))
+        self.assertTrue(decompress.eof)
+        self.assertEqual(IAC+WONT+telneter.MCCP2 + b'plain', decompress.unused_data)
+        self.assertFalse(server.compressor.active)
+        self.assertFalse(server.state.enabled(WILL, telneter.MCCP2))
+
+        stream = telneter.TelnetStream()
+        self.assertRaises(ValueError, stream.start_compression)
+        stream.stop_compression()  # nothing to stop
+        self.assertEqual(b'', stream.data_to_send())
+
+    def test_output_buffer(self):
+        stream = telneter.TelnetStream()
+        stream.send_text(b'a' + IAC + b'b' + IAC)
+        stream.send_command(WILL, STATUS)
+        stream.send_subneg(STATUS, IAC + b'x')
+        stream.send_text(b'plain')
+        expected = b'a'+IAC+IAC+b'b'+IAC+IAC + IAC+WILL+STATUS + IAC+SB+STATUS+IAC+IAC+b'x'+IAC+SE + b'plain'
+        self.assertEqual(expected, stream.data_to_send())
+        stream.consume(4)
+        self.assertEqual(expected[4:], stream.data_to_send())
+        stream.consume(len(expected))
+        self.assertEqual(b'', stream.data_to_send())
+        stream.send_text(b'more')
+        data = stream.take_data()
+        stream.send_text(b'after')
+        self.assertEqual(b'more', data)  # not the buffer we keep sending into
+        self.assertEqual(b'after', stream.data_to_send())
+
+    def test_history(self):
+        tstate = telneter.TelnetState.make_smartstate()
+        tstate.recieve_command(WILL, telneter.ECHO, b'')
+        tstate.recieve_command(telneter.AYT, None, b'')
+        tstate.recieve_command(SB, STATUS, b'x' * 100)
+        self.assertEqual([(WILL, telneter.ECHO, b'', IAC+DO+telneter.ECHO),
+                          (telneter.AYT, None, b'', b'I Am Here'),
+                          (SB, STATUS, b'x' * 64, b'')], list(tstate.history))
+
+        history = telneter.History(4)
+        for option in telneter.BYTES[:10]:
+            history.record(DO, option, b'', IAC+WONT+option)
+        self.assertEqual(4, len(history))
+        self.assertEqual(10, history.count)
+        self.assertEqual([(DO, b'\x08', b'', IAC+WONT+b'\x08'), (DO, b'\x09', b'', IAC+WONT+b'\x09')],
+                         history.recent(2))
+        self.assertEqual(16, len(history.packed))
+
+        history = telneter.History(0)
+        history.record(DO, STATUS, b'', b'')
+        self.assertEqual([], history.recent())
+
+        tstate = telneter.TelnetState()
+        for i in range(100):
+            tstate.bad_commands.append((SB, STATUS, b''))
+        self.assertEqual(telneter.BAD_COMMANDS_SIZE, len(tstate.bad_commands))
+
+    def test_session_memory(self):
+        stream = telneter.TelnetStream()
+        self.assertFalse(hasattr(stream, '__dict__'))
+        self.assertFalse(hasattr(stream.state, '__dict__'))
+        stream.receive_data(IAC+WILL+telneter.ECHO + b'hello')
+        # compiled dispatch tables and SB limits are shared too
+        shared = set(id(handlers.dispatch) for handlers in telneter.HANDLER_TABLES.values())
+        shared.add(id(telneter.SB_LIMITS))
+        size = deep_sizeof(stream, shared)
+        self.assertTrue(size <= telneter.SESSION_BYTES, size)
+
+    def test_option_table(self):
+        options = telneter.OptionTable()
+        self.assertEqual(None, options.get(STATUS))
+        self.assertEqual(None, options.get(None))
+        self.assertRaises(KeyError, lambda: options[STATUS])
+        options[STATUS] = WILL
+        options[telneter.ECHO] = DO
+        self.assertEqual(WILL, options[STATUS])
+        self.assertTrue(STATUS in options)
+        self.assertEqual([(telneter.ECHO, DO), (STATUS, WILL)], options.items())
+        self.assertEqual(2, len(options))
+        del options[STATUS]
+        self.assertEqual([telneter.ECHO], list(options))
+
+    def test_shared_handlers(self):
+        one = telneter.TelnetState.make_smartstate()
+        two = telneter.TelnetState.make_smartstate()
+        self.assertTrue(one.handlers is two.handlers)
+        self.assertEqual('smart', one.handlers_name)
+        self.assertRaises(TypeError, one.handlers.__setitem__, STATUS, telneter.dont_wont)
+
+        one.set_handler(telneter.ECHO, telneter.dont_wont)
+        self.assertEqual(None, one.handlers_name)
+        self.assertEqual(IAC+DONT+telneter.ECHO, one.recieve_command(WILL, telneter.ECHO, b''))
+        self.assertEqual(IAC+DO+telneter.ECHO, two.recieve_command(WILL, telneter.ECHO, b''))
+
+    def test_dispatch_table(self):
+        def option_handler(tstate, cmd, option, sb_data):
+            return b'option'
+
+        def cmd_handler(tstate, cmd, option, sb_data):
+            return b'cmd'
+
+        tstate = telneter.TelnetState(handlers='smart')
+        tstate.set_handler(STATUS, option_handler)
+        tstate.set_handler(DO, cmd_handler)
+        self.assertEqual(b'option', tstate.recieve_command(DO, STATUS, b''))
+        self.assertEqual(b'cmd', tstate.recieve_command(DO, telneter.NAWS, b''))
+        self.assertEqual(IAC+DONT+telneter.NAWS, tstate.recieve_command(WILL, telneter.NAWS, b''))
+        self.assertEqual(b'I Am Here', tstate.recieve_command(telneter.AYT, None, b''))
+        # already agreed, so a repeat is ignored
+        self.assertEqual(IAC+DO+telneter.ECHO, tstate.recieve_command(WILL, telneter.ECHO, b''))
+        self.assertEqual(b'', tstate.recieve_command(WILL, telneter.ECHO, b''))
+
+        other = telneter.TelnetState(handlers='smart')
+        other.set_handler(STATUS, option_handler)
+        other.set_handler(DO, cmd_handler)
+        # a session's own handlers only cost what they change, not a compiled table each
+        self.assertTrue(tstate.dispatch.base is other.dispatch.base is telneter.HANDLER_TABLES['smart'].dispatch)
+        self.assertEqual(frozenset(map(ord, [STATUS, DO])), tstate.dispatch.changed)
+
+        tstate.handlers = {}
+        self.assertEqual(b'', tstate.recieve_command(DO, STATUS, b''))
+
+    def test_reply_cache(self):
+        self.assertEqual(IAC+DO+telneter.ECHO, telneter.REPLIES[DO][telneter.ECHO])
+        with self.assertRaises(TypeError):  # shared by every session
+            telneter.REPLIES[DO][telneter.ECHO] = b''
+        for cmd, option, sb_data in [(WILL, IAC, b''), (NOP, b'', b''), (SB, telneter.MCCP2, b''),
+                                     (SB, STATUS, telneter.SEND), (SB, STATUS, IAC), (SB, STATUS, b'hi')]:
+            self.assertEqual(IAC + cmd + option + IAC_escape(sb_data) + (IAC+SE if cmd == SB else b''),
+                             telneter.construct_control(cmd, option, sb_data))
+
+        tstate = telneter.TelnetState.make_smartstate()
+        burst = [(WILL, telneter.ECHO, b''), (DO, telneter.NAWS, b''), (telneter.AYT, None, b''),
+                 (WILL, telneter.ECHO, b''), (WILL, IAC, b'')]
+        self.assertEqual(IAC+DO+telneter.ECHO + IAC+WONT+telneter.NAWS + b'I Am Here' + IAC+DONT+IAC,
+                         tstate.recieve_commands(burst))
+        # in option order, with the IAC option escaped
+        self.assertEqual(IAC+SB+STATUS+telneter.IS + DO+telneter.ECHO + WONT+telneter.NAWS + DONT+IAC+IAC + IAC+SE,
+                         tstate.construct_status())
+
+        stream = telneter.TelnetStream.make_server()
+        self.assertEqual(IAC+WILL+telneter.MCCP2 + IAC+WILL+telneter.MCCP3, stream.data_to_send())
+        self.assertEqual(WILL, stream.state.options[telneter.MCCP3])
+
+    def test_gmcp_msdp(self):
+        GMCP, MSDP = telneter.GMCP, telneter.MSDP
+        VAR, VAL = telneter.MSDP_VAR, telneter.MSDP_VAL
+        got = []
+
+        def callback(tstate, name, value):
+            got.append((name, value))
+
+        tstate = telneter.TelnetState.make_smartstate()
+        # nobody subscribed, so no thanks
+        self.assertEqual(IAC+DONT+GMCP, tstate.recieve_command(WILL, GMCP, b''))
+        self.assertEqual(b'', tstate.recieve_command(SB, GMCP, b'Char.Vitals {"hp": 1}'))
+        tstate.subscribe(GMCP, 'Char', callback)
+        tstate.subscribe(MSDP, 'ROOM', callback)
+        self.assertRaises(ValueError, tstate.subscribe, STATUS, 'x', callback)
+        self.assertEqual(IAC+DO+GMCP, tstate.recieve_command(WILL, GMCP, b''))
+        self.assertEqual(IAC+DO+MSDP, tstate.recieve_command(WILL, MSDP, b''))
+
+        with mock.patch.object(telneter.json, 'loads', wraps=telneter.json.loads) as loads:
+            for i in range(3):  # the same tick again is a memo lookup
+                tstate.recieve_command(SB, GMCP, b'Char.Vitals {"hp": 100}')
+            tstate.recieve_command(SB, GMCP, b'Room.Info {"num": 1}')
+            tstate.recieve_command(SB, GMCP, b'char.status')
+            self.assertEqual(1, loads.call_count)
+        self.assertEqual([('Char.Vitals', {'hp': 100})] * 3 + [('char.status', None)], got)
+        tstate.recieve_command(SB, GMCP, b'Char.Vitals {"hp": ')
+        self.assertEqual((SB, GMCP, b'Char.Vitals {"hp": '), tstate.bad_commands[-1])
+
+        del got[:]
+        room = (VAR+b'ROOM'+VAL + telneter.MSDP_TABLE_OPEN +
+                VAR+b'NAME'+VAL+b'The Dusty Road' +
+                VAR+b'EXITS'+VAL + telneter.MSDP_ARRAY_OPEN + VAL+b'e'+VAL+b'w' + telneter.MSDP_ARRAY_CLOSE +
+                telneter.MSDP_TABLE_CLOSE)
+        skipped = VAR+b'AREA'+VAL + telneter.MSDP_TABLE_OPEN + VAR+b'ROOM'+VAL+b'no' + telneter.MSDP_TABLE_CLOSE
+        tstate.recieve_command(SB, MSDP, skipped + room + VAR+b'ROOM'+VAL+b'1'+VAL+b'2')
+        self.assertEqual([('ROOM', {'NAME': 'The Dusty Road', 'EXITS': ['e', 'w']}), ('ROOM', ['1', '2'])], got)
+
+        tstate.unsubscribe(GMCP, 'char', callback)
+        del got[:]
+        tstate.recieve_command(SB, GMCP, b'Char.Vitals {"hp": 100}')
+        self.assertEqual([], got)
+
+    def test_q_method(self):
+        NAWS, SGA, ECHO = telneter.NAWS, telneter.SGA, telneter.ECHO
+        NO, YES, WANTNO, WANTYES = telneter.Q_NO, telneter.Q_YES, telneter.Q_WANTNO, telneter.Q_WANTYES
+        tstate = telneter.TelnetState.make_smartstate()
+        # we ask, so their WILL is an answer and doesn't go to dont_wont
+        self.assertEqual(IAC+DO+NAWS, tstate.request(DO, NAWS))
+        self.assertEqual(b'', tstate.request(DO, NAWS))
+        self.assertEqual((NO, WANTYES), tstate.q_state(NAWS))
+        self.assertEqual(b'', tstate.recieve_command(WILL, NAWS, b''))
+        self.assertEqual((NO, YES), tstate.q_state(NAWS))
+        self.assertEqual(DO, tstate.options[NAWS])
+        # they turn it off, we agree once
+        self.assertEqual(IAC+DONT+NAWS, tstate.recieve_command(WONT, NAWS, b''))
+        self.assertEqual(b'', tstate.recieve_command(WONT, NAWS, b''))
+        # they say no to our WILL, we don't answer that
+        self.assertEqual(IAC+WILL+telneter.MCCP2, tstate.request(WILL, telneter.MCCP2))
+        self.assertEqual(b'', tstate.recieve_command(DONT, telneter.MCCP2, b''))
+        self.assertEqual((NO, NO), tstate.q_state(telneter.MCCP2))
+
+        # we change our mind while waiting, the answer gets queued
+        self.assertEqual(IAC+DO+SGA, tstate.request(DO, SGA))
+        self.assertEqual(b'', tstate.request(DONT, SGA))
+        self.assertEqual(IAC+DONT+SGA, tstate.recieve_command(WILL, SGA, b''))
+        self.assertEqual((NO, WANTNO), tstate.q_state(SGA))
+        self.assertEqual(b'', tstate.recieve_command(WONT, SGA, b''))
+        self.assertEqual((NO, NO), tstate.q_state(SGA))
+
+        # both sides of an option are kept apart, and ECHO_handler's silence is a no
+        self.assertEqual(IAC+DO+ECHO, tstate.recieve_command(WILL, ECHO, b''))
+        self.assertEqual(IAC+WONT+ECHO, tstate.recieve_command(DO, ECHO, b''))
+        self.assertEqual((NO, YES), tstate.q_state(ECHO))
+
+        # an answer to something we never asked for
+        tstate.request(DO, NAWS)
+        tstate.request(DONT, NAWS)
+        tstate.recieve_command(WILL, NAWS, b'')  # WANTYES+OPPOSITE, so we send DONT
+        self.assertEqual(b'', tstate.recieve_command(WILL, NAWS, b''))
+        self.assertEqual((WILL, NAWS, b''), tstate.bad_commands[-1])
+        self.assertEqual((NO, NO), tstate.q_state(NAWS))
+
+    def test_both_sides(self):
+        # each side of an option is its own, whatever the last reply in options says
+        stream = telneter.TelnetStream()
+        stream.receive_data(IAC+WILL+telneter.ECHO + IAC+DO+telneter.ECHO)
+        self.assertEqual(IAC+DO+telneter.ECHO + IAC+WONT+telneter.ECHO, stream.take_data())
+        self.assertEqual((telneter.Q_NO, telneter.Q_YES), stream.state.q_state(telneter.ECHO))
+        self.assertFalse(stream.state.local_echo)
+
+        # we refuse to compress, but still decompress what they send
+        stream.receive_data(IAC+WILL+telneter.MCCP2 + IAC+DO+telneter.MCCP2)
+        self.assertEqual(IAC+DO+telneter.MCCP2 + IAC+WONT+telneter.MCCP2, stream.take_data())
+        events = stream.feed(IAC+SB+telneter.MCCP2+IAC+SE + zlib.compress(b'squashed'))
+        self.assertEqual(telneter.TextEvent(b'squashed'), events[-1])
+
+        server = telneter.TelnetStream()
+        server.offer(telneter.TELOPT_EOR)
+        server.receive_data(IAC+DO+telneter.TELOPT_EOR + IAC+WILL+telneter.TELOPT_EOR)
+        server.take_data()
+        server.send_prompt(b'> ')
+        self.assertEqual(b'> ' + IAC+telneter.EOR, server.data_to_send())
+
+    def test_negotiation_flood(self):
+        tstate = telneter.TelnetState.make_smartstate()
+        answered = 0
+        for i in range(1000):  # a client flipping WILL/WONT as fast as it can
+            answered += bool(tstate.recieve_command(WILL, telneter.ECHO, b''))
+            answered += bool(tstate.recieve_command(WONT, telneter.ECHO, b''))
+        self.assertEqual(telneter.NEGOTIATION_BUDGET, answered)
+        self.assertTrue(tstate.flooding)
+        self.assertEqual(1, len(tstate.bad_commands))
+        with mock.patch.object(telneter.time, 'monotonic', return_value=time.monotonic() + 2):
+            self.assertFalse(tstate.flooding)
+            self.assertTrue(tstate.recieve_command(WILL, telneter.ECHO, b'') in (IAC+DO+telneter.ECHO, b''))
+            self.assertEqual(1, tstate.negotiations)
+
+    def test_snapshot(self):
+        stream = telneter.TelnetStream(compressor=telneter.Compressor(level=9, flush=telneter.FLUSH_PROMPT))
+        stream.limit_subneg(STATUS, 100, telneter.SB_ABORT)
+        stream.offer(telneter.TELOPT_EOR)
+        stream.receive_data(IAC+WILL+telneter.ECHO + IAC+DO+telneter.MCCP2 + b'hi' + IAC+SB+STATUS + b'abc' + IAC+IAC + b'de')
+        snapshot = stream.snapshot()
+        self.assertTrue(len(snapshot) < 96, len(snapshot))
+        restored = telneter.TelnetStream.restore(snapshot)
+        self.assertEqual(stream.data_to_send(), restored.data_to_send())
+        self.assertEqual(stream.unparsed_data, restored.unparsed_data)
+        self.assertEqual(stream.state.options.items(), restored.state.options.items())
+        self.assertEqual(stream.state.q_state(telneter.TELOPT_EOR), restored.state.q_state(telneter.TELOPT_EOR))
+        self.assertEqual(snapshot, restored.snapshot())
+        rest = b'f' + IAC+SE + IAC+DO+telneter.TELOPT_EOR + IAC+SB+STATUS + b'x' * 200 + IAC+SE
+        self.assertEqual(stream.feed(rest), restored.feed(rest))
+        self.assertEqual(stream.data_to_send(), restored.data_to_send())
+        self.assertEqual(9, restored.compressor.level)
+        self.assertEqual(telneter.HISTORY_SIZE, restored.state.history.size)
+        # a session that keeps no history doesn't get one back
+        quiet = telneter.TelnetStream(telneter.TelnetState(history_size=0))
+        quiet.feed(IAC+WILL+telneter.ECHO)
+        self.assertEqual(0, telneter.TelnetStream.restore(quiet.snapshot()).state.history.size)
+
+        self.assertRaises(ValueError, telneter.TelnetStream.restore, snapshot[:-1])
+        self.assertRaises(ValueError, telneter.TelnetStream.restore, snapshot[:3])
+        self.assertRaises(ValueError, telneter.TelnetStream.restore, b'TS\x09' + snapshot[3:])
+        stream.start_compression()
+        self.assertRaises(ValueError, stream.snapshot)
+        restored.state.set_handler(telneter.ECHO, telneter.dont_wont)
+        self.assertRaises(ValueError, restored.snapshot)
+
+    def test_stats(self):
+        aggregator = telneter.StatsAggregator()
+        data = (b'hello' + IAC+WILL+telneter.ECHO + IAC+SB+STATUS + b'x' * 100 + IAC+SE +
+                IAC+NOP + IAC+SB+STATUS + b'y' * 20)
+        stream = telneter.TelnetStream()
+        self.assertEqual(None, stream.stats)
+        stats = stream.instrument(aggregator)
+        stream.receive_data(data)
+        stream.consume(len(stream.outbuf))
+        self.assertEqual(len(data), stats.bytes_in)
+        self.assertEqual(3, stats.bytes_out)  # IAC DO ECHO
+        self.assertEqual(5, stats.text_bytes)
+        self.assertEqual(3 + 105 + 2, stats.control_bytes)
+        self.assertEqual({(WILL, telneter.ECHO): 1, (SB, STATUS): 1, (NOP, None): 1}, stats.commands)
+        self.assertEqual(23, stats.peak_unparsed)
+        self.assertEqual((1, 4), (stats.parse_calls, stats.events))
+
+        other = telneter.TelnetStream()
+        other.instrument(aggregator)  # a stream that goes away still counts
+        other.receive_data(IAC+SB+STATUS + b'z' * 5000 + IAC+SE)
+        del other
+        snap = aggregator.snapshot()
+        self.assertEqual(1, snap['telneter_streams'])
+        self.assertEqual(len(data) + 5005, snap['telneter_bytes_in_total'])
+        self.assertEqual(1, snap['telneter_commands_total{cmd="WILL",option="ECHO"}'])
+        self.assertEqual(2, snap['telneter_commands_total{cmd="SB",option="STATUS"}'])
+        self.assertEqual(1, snap['telneter_sb_bytes_bucket{le="256"}'])
+        self.assertEqual(2, snap['telneter_sb_bytes_bucket{le="+Inf"}'])
+        self.assertTrue('telneter_sb_bytes_count 2\n' in telneter.prometheus_text(snap))
+
+        # a byte at a time, the peak doesn't come from adding up everything buffered every time
+        stats = stream.instrument(None)
+        for byte in b'y' * 980:
+            stream.receive_data(telneter.BYTES[byte])
+        self.assertEqual(3 + 1000, stats.peak_unparsed)
+        self.assertEqual(stream.parser.unparsed_size, len(stream.unparsed_data))
+
+    def test_benchmark_regression_gate(self):
+        import bench_telneter
+        baseline = {'fast': {'median': 100.0}, 'gone': {'median': 1.0}}
+        results = {'fast': {'median': 85.0}, 'new': {'median': 1.0}}
+        self.assertEqual([], bench_telneter.compare(results, baseline, 20))
+        self.assertEqual([('fast', 100.0, 85.0)], bench_telneter.compare(results, baseline, 10))
+        self.assertEqual(3, bench_telneter.percentile([1, 2, 3, 4, 5], 50))
+
+
+class AsyncioAdapter(unittest.TestCase):
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_replies_written_together(self):
+        transport = mock.Mock()
+        protocol = telneter_aio.TelnetProtocol()
+        protocol.connection_made(transport)
+        protocol.data_received(b'hi' + IAC+WILL+telneter.ECHO + IAC+DO+STATUS)
+        transport.write.assert_called_once_with(IAC+DO+telneter.ECHO + IAC+WONT+STATUS)
+        self.assertEqual(telneter.TextEvent(b'hi'), self.loop.run_until_complete(protocol.read_event()))
+
+    def test_backpressure(self):
+        transport = mock.Mock()
+        protocol = telneter_aio.TelnetProtocol(max_queued=4)
+        protocol.connection_made(transport)
+        protocol.data_received((IAC+telneter.NOP) * 4)
+        transport.pause_reading.assert_called_once_with()
+        for i in range(2):
+            self.loop.run_until_complete(protocol.read_event())
+        transport.resume_reading.assert_called_once_with()
+
+        protocol.pause_writing()
+        drain = self.loop.create_task(protocol.drain())
+        self.loop.run_until_complete(asyncio.sleep(0))
+        self.assertFalse(drain.done())
+        protocol.resume_writing()
+        self.loop.run_until_complete(drain)
+
+    def test_bomb_in_one_read(self):
+        # a compressed read is only inflated as fast as its events are read
+        transport = mock.Mock()
+        protocol = telneter_aio.TelnetProtocol(max_queued=4)
+        protocol.stream.parser.max_inflate = 1024
+        protocol.connection_made(transport)
+        protocol.data_received(IAC+WILL+telneter.MCCP2 + IAC+SB+telneter.MCCP2+IAC+SE)
+        protocol.data_received(zlib.compress(b'x' * 1024 * 1024))
+        self.assertEqual(4, len(protocol.events))
+        transport.pause_reading.assert_called_once_with()
+        size = 0
+        while size < 1024 * 1024:
+            event = self.loop.run_until_complete(protocol.read_event())
+            if event.__class__ is telneter.TextEvent:
+                size += len(event.text)
+            self.assertTrue(len(protocol.events) <= 4)
+        self.assertEqual(1024 * 1024, size)
+        transport.resume_reading.assert_called_once_with()
+
+    def test_loopback(self):
+        def greet(protocol):
+            protocol.write(b'hello' + IAC)
+            protocol.close()
+
+        server = self.loop.run_until_complete(telneter_aio.start_server(greet, '127.0.0.1', 0))
+        port = server.sockets[0].getsockname()[1]
+        client = self.loop.run_until_complete(telneter_aio.open_connection('127.0.0.1', port))
+        events = []
+        while True:
+            event = self.loop.run_until_complete(client.read_event())
+            if event is None:
+                break
+            events.append(event)
+        self.assertEqual([telneter.CommandEvent(WILL, telneter.MCCP2, b''),
+                          telneter.CommandEvent(WILL, telneter.MCCP3, b''),
+                          telneter.TextEvent(b'hello' + IAC)], events)
+        client.close()
+        server.close()
+        self.loop.run_until_complete(server.wait_closed())
+
+
+
+class Capture(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def test_record_replay(self):
+        chunks = [b'hello' + IAC+WILL+telneter.ECHO, IAC+SB+STATUS + b'x' * 100, IAC+SE + b'bye']
+        for compress in (False, True):
+            path = os.path.join(self.dir, 'session%d.cap' % compress)
+            clock = iter([0.0, 0.5, 1.0, 1.25]).__next__
+            recorder = telneter_capture.Recorder.open(path, compress, clock=clock)
+            stream = telneter_capture.RecordingStream(recorder=recorder)
+            for chunk in chunks[:2]:
+                stream.receive_data(chunk)
+            stream.consume(len(stream.outbuf))
+            recorder.close()
+            # appending keeps the compression it started with
+            recorder = telneter_capture.Recorder.open(path, not compress)
+            recorder.write(telneter_capture.IN, chunks[2])
+            recorder.close()
+            with open(path, 'ab') as f:
+                f.write(b'\x00\x01')  # half a record, as if we crashed while writing it
+
+            capture = telneter_capture.Capture(path)
+            self.assertEqual([(0.5, chunks[0]), (1.0, chunks[1])], capture.chunks()[:2])
+            self.assertEqual(chunks, [data for when, data in capture.chunks()])
+            self.assertEqual([(1.25, IAC+DO+telneter.ECHO)], capture.chunks(telneter_capture.OUT))
+            report = telneter_capture.replay(capture.chunks(), streams=3)
+            capture.close()
+            self.assertEqual((9, 3 * 4), (report['chunks'], report['events']))
+            self.assertTrue(report['latency_p50_us'] <= report['latency_p99_us'] <= report['latency_max_us'])
+
+        with open(path, 'wb') as f:
+            f.write(b'not a capture')
+        self.assertRaises(ValueError, telneter_capture.Capture, path)
+
+    def test_append_after_crash(self):
+        for compress in (False, True):
+            path = os.path.join(self.dir, 'crashed%d.cap' % compress)
+            recorder = telneter_capture.Recorder.open(path, compress)
+            recorder.write(telneter_capture.IN, b'one')
+            recorder.write(telneter_capture.IN, b'two')
+            # crash: the zlib stream is never finished and the last record is half written
+            recorder.f.write(b'\x00\x01\x02')
+            recorder.f.close()
+            recorder = telneter_capture.Recorder.open(path)
+            recorder.write(telneter_capture.IN, b'three')
+            recorder.close()
+            capture = telneter_capture.Capture(path)
+            self.assertEqual([b'one', b'two', b'three'], [data for when, data in capture.chunks()])
+            capture.close()
+
+        # a corrupt stream keeps what came before it and the streams after it
+        recorder = telneter_capture.Recorder.open(path)
+        recorder.write(telneter_capture.IN, b'four')
+        recorder.f.write(telneter_capture.SEGMENT.pack(False, 4) + b'\xff' * 4)  # not deflate
+        recorder.write(telneter_capture.IN, b'lost')
+        recorder.close()
+        recorder = telneter_capture.Recorder.open(path)
+        recorder.write(telneter_capture.IN, b'five')
+        recorder.close()
+        capture = telneter_capture.Capture(path)
+        self.assertEqual([b'one', b'two', b'three', b'four', b'five'], [data for when, data in capture.chunks()])
+        capture.close()
+
+
+class SessionPool(unittest.TestCase):
+    def test_matches_one_stream(self):
+        # a subnegotiation split across batches only works if a session stays in its worker
+        chunks = [b'hi' + IAC+WILL+telneter.ECHO + IAC+SB+STATUS, b'x' * 300 + IAC, SE + b'bye' + IAC+NOP]
+        conn_ids = [1, 2, 7, 10]
+        with telneter_pool.SessionPool(workers=2, buffer_size=256) as pool:
+            results = [pool.feed([(conn_id, chunk) for conn_id in conn_ids]) for chunk in chunks]
+            pool.close_sessions([2])
+            again = pool.feed([(2, chunks[2]), (7, b'a'), (7, b'b')])
+            lazy = pool.feed([(10, chunks[0])])[0][1]
+
+        for i, chunk in enumerate(chunks):
+            stream = telneter.TelnetStream()
+            for previous in chunks[:i]:
+                stream.feed(previous)
+            del stream.outbuf[:]
+            expected = (stream.feed(chunk), bytes(stream.outbuf))
+            for conn_id, (got_id, events, outbound) in zip(conn_ids, results[i]):
+                self.assertEqual((conn_id, expected), (got_id, (events, outbound)))
+        self.assertEqual(IAC+DO+telneter.ECHO, results[0][0][2])
+        # events are only decoded when they are looked at, the encoding is there as is
+        self.assertIsNone(lazy._events)
+        self.assertEqual(lazy.encoded(), telneter_pool.encode_events(telneter.TelnetStream().feed(chunks[0])))
+        self.assertEqual(telneter_pool.decode_events(lazy.encoded()), lazy)
+        # a closed session starts over
+        self.assertEqual(telneter.TelnetStream().feed(chunks[2]), again[0][1])
+        self.assertEqual([(7, [telneter.TextEvent(b'a')], b''), (7, [telneter.TextEvent(b'b')], b'')], again[1:])